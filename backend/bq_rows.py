@@ -0,0 +1,51 @@
+"""
+Storage Write API row layouts shared by the backend and scripts/write-to-bq.py
+"""
+from datetime import date
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+import functools
+
+
+# Column encodings, in table column order below
+STRING = descriptor_pb2.FieldDescriptorProto.TYPE_STRING
+DOUBLE = descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE
+DATE = descriptor_pb2.FieldDescriptorProto.TYPE_INT32  # days since epoch
+TIMESTAMP = descriptor_pb2.FieldDescriptorProto.TYPE_INT64  # epoch micros
+JSON = descriptor_pb2.FieldDescriptorProto.TYPE_STRING
+
+WRITE_TABLE_FIELDS = {
+    "exceptions": [
+        ("exception_id", STRING), ("invoice_id", STRING), ("message_id", STRING),
+        ("filename", STRING), ("gcs_uri", STRING), ("received_date", DATE),
+        ("invoice_date", DATE), ("supplier_name", STRING), ("total_amount", DOUBLE),
+        ("exception_type", STRING), ("exception_severity", STRING), ("all_exceptions", JSON),
+        ("status", STRING), ("raw_extracted_data", JSON), ("created_at", TIMESTAMP)
+    ],
+    "invoices_processed": [
+        ("invoice_id", STRING), ("message_id", STRING), ("filename", STRING),
+        ("gcs_uri", STRING), ("received_date", DATE), ("invoice_date", DATE),
+        ("supplier_name", STRING), ("total_amount", DOUBLE), ("net_amount", DOUBLE),
+        ("total_tax_amount", DOUBLE), ("currency", STRING), ("raw_extracted_data", JSON)
+    ]
+}
+
+EPOCH_DATE = date(1970, 1, 1)
+
+
+@functools.lru_cache(maxsize=None)
+def row_type(table):
+    """Build the protobuf message class the Storage Write API expects for a table"""
+    file_proto = descriptor_pb2.FileDescriptorProto(name=f"{table}_row.proto", package="invoice_rows")
+    message_proto = file_proto.message_type.add(name=f"{table}_row")
+    for number, (name, field_type) in enumerate(WRITE_TABLE_FIELDS[table], start=1):
+        message_proto.field.add(
+            name=name,
+            number=number,
+            type=field_type,
+            label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+        )
+
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    descriptor = pool.FindMessageTypeByName(f"invoice_rows.{table}_row")
+    return message_factory.MessageFactory(pool).GetPrototype(descriptor), message_proto
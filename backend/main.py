@@ -1,51 +1,238 @@
 """
 Invoice Exception Management API - With Optional Auth
 """
-from fastapi import FastAPI, HTTPException, Query, Header
+from fastapi import Depends, FastAPI, HTTPException, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Optional
-from datetime import date, datetime
+from typing import List, Literal, Optional
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
 from pydantic import BaseModel
+from cachetools import TTLCache
+import google.auth
+import google.auth.credentials
+import google.auth.exceptions
+import google.auth.transport.requests
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
+from google.cloud.bigquery_storage_v1 import types as bqs_types
+from google.cloud.bigquery_storage_v1 import writer as bqs_writer
+from google.cloud.bigquery_storage_v1.exceptions import StreamClosedError
 from google.cloud import storage
-from fastapi.responses import StreamingResponse
+from google.cloud.exceptions import NotFound
+from fastapi.responses import ORJSONResponse, RedirectResponse, StreamingResponse
+import anyio.to_thread
+import asyncio
+import functools
+import itertools
 import os
+import threading
+import traceback
+import urllib.parse
 import uuid
-import json
+import orjson
+import requests.adapters
 
+from bq_rows import EPOCH_DATE, row_type
+
+
+# BigQuery/GCS calls wait in worker threads; size the pools for many concurrent waits
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", 100))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE))
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREAD_POOL_SIZE
+    yield
 
 
 app = FastAPI(
     title="Invoice Exception Management API",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
+# Comma-separated dashboard origins; an explicit list lets preflights skip wildcard origin echoing.
+# "*" is honoured only when set explicitly, and then without credentials.
+CORS_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("CORS_ORIGINS", "http://localhost:3000,http://localhost:3001").split(",")
+    if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=CORS_ORIGINS,
+    allow_credentials="*" not in CORS_ORIGINS,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 project_id = os.getenv("GCP_PROJECT_ID", "consulevent-ap-invoice")
 dataset_id = os.getenv("BIGQUERY_DATASET", "invoice_processing")
-bq_client = bigquery.Client(project=project_id)
+
+# Application default credentials, shared by the REST clients below; cloud-platform covers BigQuery and GCS
+gcp_credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+
+
+def pooled_session():
+    """requests keeps only 10 connections per host by default; with THREAD_POOL_SIZE
+    concurrent calls the rest would open (and TLS-handshake) throwaway connections"""
+    session = google.auth.transport.requests.AuthorizedSession(gcp_credentials)
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=THREAD_POOL_SIZE))
+    return session
+
+
+# BigQuery and GCS JSON APIs go over REST sessions, not gRPC channels
+bq_client = bigquery.Client(project=project_id, credentials=gcp_credentials, _http=pooled_session())
+bqstorage_client = bigquery_storage.BigQueryReadClient()
+bq_write_client = bigquery_storage.BigQueryWriteClient()
+storage_client = storage.Client(project=project_id, credentials=gcp_credentials, _http=pooled_session())
+
+PDF_URL_EXPIRATION = timedelta(hours=1)
+PDF_CHUNK_SIZE = 256 * 1024
+DISPOSITION_STRIP = str.maketrans("", "", '"\\\r\n')
+
+# id -> gcs_uri for the PDF endpoints; shared by worker threads
+gcs_uri_cache = TTLCache(maxsize=4096, ttl=300)
+# gcs_uri -> True for PDFs seen in GCS, so redirects skip the existence probe
+pdf_exists_cache = TTLCache(maxsize=4096, ttl=300)
+gcs_uri_lock = threading.RLock()
+
+# List endpoints send a small first page fast, then read the rest in bulk
+FIRST_PAGE_SIZE = 50
+PAGE_SIZE = 500
+
+# Dashboard polls /api/stats; serve repeats from memory for a short window.
+# These caches are per process: a write clears them only in the worker that handled it,
+# other workers and instances keep serving their entries until the TTL runs out, so the
+# TTLs are kept short.
+stats_cache = TTLCache(maxsize=1, ttl=int(os.getenv("STATS_CACHE_TTL", 15)))
+stats_lock = asyncio.Lock()
+
+# Same for /api/exceptions, keyed by the filter combination; cleared on every exception write
+exceptions_list_cache = TTLCache(maxsize=256, ttl=int(os.getenv("LIST_CACHE_TTL", 15)))
+exceptions_list_locks = {}
+
+# Detail pane lookups by exception_id; an id's entry is dropped when it is reviewed or
+# rewritten. Per process like the caches above, so the TTL is kept short.
+exception_cache = TTLCache(maxsize=1024, ttl=int(os.getenv("EXCEPTION_CACHE_TTL", 15)))
+exception_locks = {}
+
+# Bumped on every invalidation; a fill that started under an older generation read
+# pre-write data and is returned to its caller but not stored
+cache_generation = 0
+
+
+def invalidate_exception_caches(exception_id):
+    """Drop cached stats, exception lists and the written exception after a write in this process"""
+    global cache_generation
+    cache_generation += 1
+    stats_cache.clear()
+    exceptions_list_cache.clear()
+    exception_cache.pop(exception_id, None)
+
 
 # Disable auth for local development
 USE_AUTH = False
 
 
-async def verify_token(authorization: Optional[str] = Header(None)):
-    """Optional auth verification"""
+@functools.lru_cache(maxsize=4096)
+def _cached_verify(token: str) -> dict:
     if not USE_AUTH:
         return {"email": "local-dev@example.com"}
     # Auth code here if needed
     return {}
 
 
+async def verify_token(authorization: Optional[str] = Header(None)) -> dict:
+    """Optional auth verification, results cached per token"""
+    return _cached_verify(authorization or "")
+
+
+# Python value type -> BigQuery parameter type for scalar_params
+PARAM_TYPES = {str: "STRING", int: "INT64", float: "FLOAT64", bool: "BOOL", date: "DATE"}
+
+
+def scalar_params(**params):
+    """Query parameters with BigQuery types inferred from the (non-None) values"""
+    return [bigquery.ScalarQueryParameter(name, PARAM_TYPES[type(value)], value) for name, value in params.items()]
+
+
+async def run_query(query, job_config=None):
+    """Run a query and wait for its rows in a worker thread so the event loop keeps serving other requests"""
+    return await asyncio.to_thread(lambda: list(bq_client.query_and_wait(query, job_config=job_config)))
+
+
+def stream_json_array(rows, row_to_dict=None):
+    """Yield a JSON array one row at a time so the first bytes go out before the last row is read"""
+    if row_to_dict is not None:
+        rows = map(row_to_dict, rows)
+    yield b"["
+    first = True
+    for row in rows:
+        if not first:
+            yield b","
+        yield orjson.dumps(row)
+        first = False
+    yield b"]"
+
+
+def stream_ndjson(rows, row_to_dict=None):
+    """Yield one JSON document per line so clients can render rows as they arrive"""
+    if row_to_dict is not None:
+        rows = map(row_to_dict, rows)
+    for row in rows:
+        yield orjson.dumps(row) + b"\n"
+
+
+def list_response(rows, accept, row_to_dict=None):
+    """Stream rows as NDJSON when the client asks for it, otherwise as a JSON array"""
+    if accept and "application/x-ndjson" in accept:
+        return StreamingResponse(stream_ndjson(rows, row_to_dict), media_type="application/x-ndjson")
+    return StreamingResponse(stream_json_array(rows, row_to_dict), media_type="application/json")
+
+
+def iter_result_rows(query_job):
+    """
+    Rows of a finished query as dicts: a small first page straight from the
+    query response, then the rest as Arrow record batches over the BigQuery
+    Storage Read API. Waits for the job, so query errors raise here.
+    """
+    first_page = [dict(row.items()) for row in query_job.result(max_results=FIRST_PAGE_SIZE)]
+    if len(first_page) < FIRST_PAGE_SIZE:
+        return iter(first_page)
+    return itertools.chain(first_page, _iter_arrow_rows(query_job, skip=FIRST_PAGE_SIZE))
+
+
+def _iter_arrow_rows(query_job, skip):
+    results = query_job.result(page_size=PAGE_SIZE)
+    for batch in results.to_arrow_iterable(bqstorage_client=bqstorage_client):
+        if skip:
+            skipped = min(skip, batch.num_rows)
+            batch = batch.slice(skipped)
+            skip -= skipped
+        yield from batch.to_pylist()
+
+
+def _parse_json_column(value):
+    """Arrow hands JSON columns back as strings, the REST first page already parsed"""
+    return orjson.loads(value) if isinstance(value, str) else value
+
+
+def invoice_row_to_dict(row):
+    # Arrow rows are already dicts of exactly the selected columns, fill in the rest in place
+    row["status"] = "PROCESSED"  # invoices_processed table doesn't have status column
+    if "raw_extracted_data" in row:
+        row["line_items"] = _parse_json_column(row["line_items"])
+        row["raw_extracted_data"] = _parse_json_column(row["raw_extracted_data"])
+    return row
+
+
 class ExceptionUpdate(BaseModel):
-    status: str
+    status: Literal["PENDING", "APPROVED", "REJECTED"]
     reviewed_by: str
     review_comments: Optional[str] = None
 
@@ -73,148 +260,209 @@ async def root():
     }
 
 
+LIST_EXCEPTIONS_QUERY = f"""
+SELECT 
+    e.exception_id,
+    e.invoice_id,
+    e.filename,
+    e.supplier_name,
+    CAST(e.total_amount AS FLOAT64) as total_amount,
+    e.exception_type,
+    e.exception_severity,
+    COALESCE(r.review_status, e.status) as status,
+    FORMAT_TIMESTAMP('%Y-%m-%dT%H:%M:%E6S%Ez', e.created_at) as created_at,
+    r.reviewed_by,
+    FORMAT_TIMESTAMP('%Y-%m-%dT%H:%M:%E6S%Ez', r.reviewed_at) as reviewed_at
+FROM `{project_id}.{dataset_id}.exceptions` e
+LEFT JOIN `{project_id}.{dataset_id}.exception_reviews_latest` r ON e.exception_id = r.exception_id
+WHERE (ARRAY_LENGTH(@status) = 0 OR COALESCE(r.review_status, e.status) IN UNNEST(@status))
+  AND (ARRAY_LENGTH(@severity) = 0 OR e.exception_severity IN UNNEST(@severity))
+  AND e.received_date >= @start_date
+  AND (@end_date IS NULL OR e.received_date <= @end_date)
+ORDER BY e.created_at DESC
+LIMIT @limit
+"""
+
+
 @app.get("/api/exceptions", response_model=List[ExceptionResponse])
 async def list_exceptions(
-    authorization: Optional[str] = Header(None),
-    status: Optional[str] = Query(None),
-    severity: Optional[str] = Query(None),
-    start_date: Optional[str] = Query(None),
-    end_date: Optional[str] = Query(None),
-    limit: int = Query(100, le=1000)
+    user: dict = Depends(verify_token),
+    status: List[str] = Query([]),
+    severity: List[str] = Query([]),
+    start_date: Optional[date] = Query(None),
+    end_date: Optional[date] = Query(None),
+    limit: int = Query(100, le=1000),
+    accept: Optional[str] = Header(None)
 ):
     """Get exceptions with latest review status"""
-    await verify_token(authorization)
+    # exceptions is partitioned by received_date, always bound the scan
+    if start_date is None:
+        start_date = datetime.now(timezone.utc).date() - timedelta(days=30)
     
-    query = f"""
-    WITH latest_reviews AS (
-      SELECT 
-        exception_id,
-        status as review_status,
-        reviewed_by,
-        reviewed_at,
-        ROW_NUMBER() OVER (PARTITION BY exception_id ORDER BY reviewed_at DESC) as rn
-      FROM `{project_id}.{dataset_id}.exception_reviews`
+    # Fixed query text + bound parameters so BigQuery can serve repeated
+    # dashboard polls from its result cache
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ArrayQueryParameter("status", "STRING", status),
+            bigquery.ArrayQueryParameter("severity", "STRING", severity),
+            bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+            bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+            bigquery.ScalarQueryParameter("limit", "INT64", limit)
+        ],
+        use_query_cache=True
     )
-    SELECT 
-        e.exception_id,
-        e.invoice_id,
-        e.filename,
-        e.supplier_name,
-        e.total_amount,
-        e.exception_type,
-        e.exception_severity,
-        COALESCE(r.review_status, e.status) as status,
-        e.created_at,
-        r.reviewed_by,
-        r.reviewed_at
-    FROM `{project_id}.{dataset_id}.exceptions` e
-    LEFT JOIN latest_reviews r ON e.exception_id = r.exception_id AND r.rn = 1
-    WHERE 1=1
-    """
     
-    if status:
-        query += f" AND COALESCE(r.review_status, e.status) = '{status}'"
-    if severity:
-        query += f" AND e.exception_severity = '{severity}'"
-    if start_date:
-        query += f" AND e.received_date >= '{start_date}'"
-    if end_date:
-        query += f" AND e.received_date <= '{end_date}'"
-    
-    query += f" ORDER BY e.created_at DESC LIMIT {limit}"
+    cache_key = (tuple(status), tuple(severity), start_date, end_date, limit)
     
     try:
-        query_job = bq_client.query(query)
-        results = query_job.result()
-        
-        exceptions = []
-        for row in results:
-            exceptions.append({
-                "exception_id": row.exception_id,
-                "invoice_id": row.invoice_id,
-                "filename": row.filename,
-                "supplier_name": row.supplier_name,
-                "total_amount": row.total_amount,
-                "exception_type": row.exception_type,
-                "exception_severity": row.exception_severity,
-                "status": row.status,
-                "created_at": row.created_at,
-                "reviewed_by": row.reviewed_by,
-                "reviewed_at": row.reviewed_at
-            })
-        
-        return exceptions
+        rows = exceptions_list_cache.get(cache_key)
+        if rows is None:
+            # One query per filter combination: concurrent misses on the same key wait for it
+            lock = exceptions_list_locks.setdefault(cache_key, asyncio.Lock())
+            try:
+                async with lock:
+                    rows = exceptions_list_cache.get(cache_key)
+                    if rows is None:
+                        generation = cache_generation
+                        rows = await asyncio.to_thread(lambda: list(iter_result_rows(bq_client.query(LIST_EXCEPTIONS_QUERY, job_config=job_config))))
+                        if generation == cache_generation:
+                            exceptions_list_cache[cache_key] = rows
+            finally:
+                if exceptions_list_locks.get(cache_key) is lock:
+                    del exceptions_list_locks[cache_key]
+        
+        # The SELECT list is exactly ExceptionResponse, rows go out as they come from Arrow
+        return list_response(rows, accept)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Query failed: {str(e)}")
 
 
+GET_EXCEPTION_QUERY = f"""
+SELECT 
+    e.exception_id,
+    e.invoice_id,
+    e.message_id,
+    e.filename,
+    e.gcs_uri,
+    FORMAT_DATE('%Y-%m-%d', e.received_date) as received_date,
+    FORMAT_DATE('%Y-%m-%d', e.invoice_date) as invoice_date,
+    e.supplier_name,
+    CAST(e.total_amount AS FLOAT64) as total_amount,
+    e.exception_type,
+    e.exception_severity,
+    e.all_exceptions,
+    e.status,
+    FORMAT_TIMESTAMP('%Y-%m-%dT%H:%M:%E6S%Ez', e.created_at) as created_at,
+    IF(r.exception_id IS NULL, NULL, STRUCT(
+      r.review_status,
+      r.reviewed_by,
+      FORMAT_TIMESTAMP('%Y-%m-%dT%H:%M:%E6S%Ez', r.reviewed_at) as reviewed_at,
+      r.review_comments
+    )) as latest_review
+FROM `{project_id}.{dataset_id}.exceptions` e
+LEFT JOIN `{project_id}.{dataset_id}.exception_reviews_latest` r ON e.exception_id = r.exception_id
+WHERE e.exception_id = @exception_id
+"""
+
+
+async def load_exception(exception_id):
+    """Exception with its latest review as the API returns it, or None for an unknown id"""
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=scalar_params(exception_id=exception_id)
+    )
+    results = await run_query(GET_EXCEPTION_QUERY, job_config)
+    
+    if not results:
+        return None
+    
+    row = results[0]
+    latest_review = row.latest_review or {}
+    
+    exception = {
+        "exception_id": row.exception_id,
+        "invoice_id": row.invoice_id,
+        "message_id": row.message_id,
+        "filename": row.filename,
+        "gcs_uri": row.gcs_uri,
+        "received_date": row.received_date,
+        "invoice_date": row.invoice_date,
+        "supplier_name": row.supplier_name,
+        "total_amount": row.total_amount,
+        "exception_type": row.exception_type,
+        "exception_severity": row.exception_severity,
+        "all_exceptions": row.all_exceptions,
+        "status": latest_review.get("review_status") or row.status,
+        "reviewed_by": latest_review.get("reviewed_by"),
+        "reviewed_at": latest_review.get("reviewed_at"),
+        "review_comments": latest_review.get("review_comments"),
+        "created_at": row.created_at
+    }
+    return exception
+
+
 @app.get("/api/exceptions/{exception_id}")
 async def get_exception(
     exception_id: str,
-    authorization: Optional[str] = Header(None)
+    user: dict = Depends(verify_token)
 ):
     """Get exception with latest review"""
-    await verify_token(authorization)
+    cached = exception_cache.get(exception_id)
+    if cached is not None:
+        return cached
     
+    try:
+        # One lookup per id: concurrent misses on the same exception wait for it
+        lock = exception_locks.setdefault(exception_id, asyncio.Lock())
+        try:
+            async with lock:
+                exception = exception_cache.get(exception_id)
+                if exception is None:
+                    generation = cache_generation
+                    exception = await load_exception(exception_id)
+                    
+                    # Unknown ids are not cached, a newly written exception is found next time
+                    if exception is None:
+                        raise HTTPException(status_code=404, detail="Exception not found")
+                    if generation == cache_generation:
+                        exception_cache[exception_id] = exception
+        finally:
+            if exception_locks.get(exception_id) is lock:
+                del exception_locks[exception_id]
+        
+        return exception
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Query failed: {str(e)}")
+
+
+@app.get("/api/exceptions/{exception_id}/raw")
+async def get_exception_raw(
+    exception_id: str,
+    user: dict = Depends(verify_token)
+):
+    """Get the raw extracted data for an exception (kept out of get_exception, it's the big column)"""
     query = f"""
-    WITH latest_review AS (
-      SELECT 
-        exception_id,
-        status as review_status,
-        reviewed_by,
-        reviewed_at,
-        review_comments
-      FROM `{project_id}.{dataset_id}.exception_reviews`
-      WHERE exception_id = @exception_id
-      ORDER BY reviewed_at DESC
-      LIMIT 1
-    )
-    SELECT 
-        e.*,
-        r.review_status,
-        r.reviewed_by as latest_reviewed_by,
-        r.reviewed_at as latest_reviewed_at,
-        r.review_comments as latest_review_comments
-    FROM `{project_id}.{dataset_id}.exceptions` e
-    LEFT JOIN latest_review r ON e.exception_id = r.exception_id
-    WHERE e.exception_id = @exception_id
+    SELECT raw_extracted_data
+    FROM `{project_id}.{dataset_id}.exceptions`
+    WHERE exception_id = @exception_id
     """
     
     job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("exception_id", "STRING", exception_id)
-        ]
+        query_parameters=scalar_params(exception_id=exception_id)
     )
     
     try:
-        query_job = bq_client.query(query, job_config=job_config)
-        results = list(query_job.result())
+        results = await run_query(query, job_config)
         
         if not results:
             raise HTTPException(status_code=404, detail="Exception not found")
         
-        row = results[0]
-        
         return {
-            "exception_id": row.exception_id,
-            "invoice_id": row.invoice_id,
-            "message_id": row.message_id,
-            "filename": row.filename,
-            "gcs_uri": row.gcs_uri,
-            "received_date": row.received_date.isoformat() if row.received_date else None,
-            "invoice_date": row.invoice_date.isoformat() if row.invoice_date else None,
-            "supplier_name": row.supplier_name,
-            "total_amount": row.total_amount,
-            "exception_type": row.exception_type,
-            "exception_severity": row.exception_severity,
-            "all_exceptions": row.all_exceptions,
-            "status": row.review_status if row.review_status else row.status,
-            "reviewed_by": row.latest_reviewed_by,
-            "reviewed_at": row.latest_reviewed_at.isoformat() if row.latest_reviewed_at else None,
-            "review_comments": row.latest_review_comments,
-            "created_at": row.created_at.isoformat() if row.created_at else None,
-            "raw_extracted_data": row.raw_extracted_data
+            "exception_id": exception_id,
+            "raw_extracted_data": _parse_json_column(results[0].raw_extracted_data)
         }
         
     except HTTPException:
@@ -223,59 +471,46 @@ async def get_exception(
         raise HTTPException(status_code=500, detail=f"Query failed: {str(e)}")
 
 
+# Review + audit rows go in as one transactional script: one job, one round-trip, both or neither
+UPDATE_EXCEPTION_QUERY = f"""
+BEGIN TRANSACTION;
+
+INSERT INTO `{project_id}.{dataset_id}.exception_reviews`
+(review_id, exception_id, status, reviewed_by, reviewed_at, review_comments)
+VALUES (@review_id, @exception_id, @status, @reviewed_by, CURRENT_TIMESTAMP(), @review_comments);
+
+INSERT INTO `{project_id}.{dataset_id}.audit_trail`
+(audit_id, exception_id, action, action_by, action_date, action_timestamp, comments)
+VALUES (@audit_id, @exception_id, @status, @reviewed_by, CURRENT_DATE(), CURRENT_TIMESTAMP(), @review_comments);
+
+COMMIT TRANSACTION;
+"""
+
+
 @app.put("/api/exceptions/{exception_id}")
 async def update_exception(
     exception_id: str,
     update: ExceptionUpdate,
-    authorization: Optional[str] = Header(None)
+    user: dict = Depends(verify_token)
 ):
     """Insert review record"""
-    await verify_token(authorization)
-    
-    valid_statuses = ["PENDING", "APPROVED", "REJECTED"]
-    if update.status not in valid_statuses:
-        raise HTTPException(status_code=400, detail=f"Invalid status")
-    
     review_id = str(uuid.uuid4())
-    query = f"""
-    INSERT INTO `{project_id}.{dataset_id}.exception_reviews`
-    (review_id, exception_id, status, reviewed_by, reviewed_at, review_comments)
-    VALUES (@review_id, @exception_id, @status, @reviewed_by, CURRENT_TIMESTAMP(), @review_comments)
-    """
+    audit_id = str(uuid.uuid4())
     
     job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("review_id", "STRING", review_id),
-            bigquery.ScalarQueryParameter("exception_id", "STRING", exception_id),
-            bigquery.ScalarQueryParameter("status", "STRING", update.status),
-            bigquery.ScalarQueryParameter("reviewed_by", "STRING", update.reviewed_by),
-            bigquery.ScalarQueryParameter("review_comments", "STRING", update.review_comments or "")
-        ]
+        query_parameters=scalar_params(
+            review_id=review_id,
+            audit_id=audit_id,
+            exception_id=exception_id,
+            status=update.status,
+            reviewed_by=update.reviewed_by,
+            review_comments=update.review_comments or ""
+        )
     )
     
     try:
-        query_job = bq_client.query(query, job_config=job_config)
-        query_job.result()
-        
-        audit_id = str(uuid.uuid4())
-        audit_query = f"""
-        INSERT INTO `{project_id}.{dataset_id}.audit_trail`
-        (audit_id, exception_id, action, action_by, action_date, action_timestamp, comments)
-        VALUES (@audit_id, @exception_id, @action, @action_by, CURRENT_DATE(), CURRENT_TIMESTAMP(), @comments)
-        """
-        
-        audit_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("audit_id", "STRING", audit_id),
-                bigquery.ScalarQueryParameter("exception_id", "STRING", exception_id),
-                bigquery.ScalarQueryParameter("action", "STRING", update.status),
-                bigquery.ScalarQueryParameter("action_by", "STRING", update.reviewed_by),
-                bigquery.ScalarQueryParameter("comments", "STRING", update.review_comments or "")
-            ]
-        )
-        
-        audit_job = bq_client.query(audit_query, job_config=audit_config)
-        audit_job.result()
+        await run_query(UPDATE_EXCEPTION_QUERY, job_config)
+        invalidate_exception_caches(exception_id)
         
         return {
             "status": "success",
@@ -289,43 +524,62 @@ async def update_exception(
         raise HTTPException(status_code=500, detail=f"Update failed: {str(e)}")
 
 
+STATS_QUERY = f"""
+SELECT 
+    COUNT(*) as total,
+    COUNTIF(status = 'PENDING') as pending,
+    COUNTIF(status = 'APPROVED') as approved,
+    COUNTIF(status = 'REJECTED') as rejected,
+    COUNTIF(severity = 'high') as sev_high,
+    COUNTIF(severity = 'medium') as sev_medium,
+    COUNTIF(severity = 'low') as sev_low
+FROM (
+  SELECT 
+      COALESCE(r.review_status, e.status) as status,
+      e.exception_severity as severity
+  FROM `{project_id}.{dataset_id}.exceptions` e
+  LEFT JOIN `{project_id}.{dataset_id}.exception_reviews_latest` r ON e.exception_id = r.exception_id
+  WHERE e.received_date >= @start_date
+)
+"""
+
+# Stats cover this many days of received exceptions
+STATS_WINDOW_DAYS = 30
+
+
 @app.get("/api/stats")
-async def get_statistics(authorization: Optional[str] = Header(None)):
+async def get_statistics(user: dict = Depends(verify_token)):
     """Get stats with review statuses"""
-    await verify_token(authorization)
+    cached = stats_cache.get("stats")
+    if cached is not None:
+        return cached
     
-    query = f"""
-    WITH latest_reviews AS (
-      SELECT 
-        exception_id,
-        status,
-        ROW_NUMBER() OVER (PARTITION BY exception_id ORDER BY reviewed_at DESC) as rn
-      FROM `{project_id}.{dataset_id}.exception_reviews`
+    # The window start is bound from here: CURRENT_DATE() in the SQL would make
+    # the query non-deterministic and opt it out of BigQuery's result cache
+    start_date = datetime.now(timezone.utc).date() - timedelta(days=STATS_WINDOW_DAYS)
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=scalar_params(start_date=start_date),
+        use_query_cache=True,
+        labels={"endpoint": "stats"}
     )
-    SELECT 
-        COALESCE(r.status, e.status) as status,
-        e.exception_severity,
-        COUNT(*) as count
-    FROM `{project_id}.{dataset_id}.exceptions` e
-    LEFT JOIN latest_reviews r ON e.exception_id = r.exception_id AND r.rn = 1
-    WHERE e.received_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY)
-    GROUP BY COALESCE(r.status, e.status), e.exception_severity
-    """
     
     try:
-        query_job = bq_client.query(query)
-        results = query_job.result()
-        
-        stats = {
-            "total_exceptions": 0,
-            "by_status": {"PENDING": 0, "APPROVED": 0, "REJECTED": 0},
-            "by_severity": {"high": 0, "medium": 0, "low": 0}
-        }
-        
-        for row in results:
-            stats["total_exceptions"] += row.count
-            stats["by_status"][row.status] = stats["by_status"].get(row.status, 0) + row.count
-            stats["by_severity"][row.exception_severity] = stats["by_severity"].get(row.exception_severity, 0) + row.count
+        # One refresh at a time: callers arriving during a miss wait for it instead of each querying
+        async with stats_lock:
+            cached = stats_cache.get("stats")
+            if cached is not None:
+                return cached
+            
+            generation = cache_generation
+            row = (await run_query(STATS_QUERY, job_config))[0]
+            
+            stats = {
+                "total_exceptions": row.total,
+                "by_status": {"PENDING": row.pending, "APPROVED": row.approved, "REJECTED": row.rejected},
+                "by_severity": {"high": row.sev_high, "medium": row.sev_medium, "low": row.sev_low}
+            }
+            if generation == cache_generation:
+                stats_cache["stats"] = stats
         
         return stats
         
@@ -334,106 +588,187 @@ async def get_statistics(authorization: Optional[str] = Header(None)):
 
 @app.get("/api/invoices/all")
 async def get_all_invoices(
-    authorization: Optional[str] = Header(None),
-    limit: int = Query(100, le=1000)
+    user: dict = Depends(verify_token),
+    limit: int = Query(100, le=1000),
+    include_raw: bool = Query(False),
+    accept: Optional[str] = Header(None)
 ):
     """Get all processed invoices for testing"""
-    await verify_token(authorization)
+    # The JSON blobs dominate bytes read, only fetch them when asked
+    raw_columns = """,
+        line_items,
+        raw_extracted_data""" if include_raw else ""
     
     query = f"""
     SELECT 
         invoice_id,
         supplier_name,
-        invoice_date,
-        total_amount,
-        gcs_uri,
-        line_items,
-        raw_extracted_data
+        FORMAT_DATE('%Y-%m-%d', invoice_date) as invoice_date,
+        CAST(total_amount AS FLOAT64) as total_amount,
+        gcs_uri{raw_columns}
     FROM `{project_id}.{dataset_id}.invoices_processed`
     ORDER BY received_date DESC
-    LIMIT {limit}
+    LIMIT @limit
     """
     
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=scalar_params(limit=limit),
+        use_query_cache=True
+    )
+    
     try:
-        query_job = bq_client.query(query)
-        results = query_job.result()
+        rows = await asyncio.to_thread(lambda: iter_result_rows(bq_client.query(query, job_config=job_config)))
         
-        invoices = []
-        for row in results:
-            invoices.append({
-                "invoice_id": row.invoice_id,
-                "supplier_name": row.supplier_name,
-                "invoice_date": row.invoice_date.isoformat() if row.invoice_date else None,
-                "total_amount": row.total_amount,
-                "gcs_uri": row.gcs_uri,
-                "status": "PROCESSED",  # invoices_processed table doesn't have status column
-                "line_items": row.line_items if hasattr(row, 'line_items') else None,
-                "raw_extracted_data": row.raw_extracted_data if hasattr(row, 'raw_extracted_data') else None
-            })
-        
-        return invoices
+        return list_response(rows, accept, invoice_row_to_dict)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Query failed: {str(e)}")
 
 
-@app.get("/api/invoices/{invoice_id}/pdf")
-async def get_invoice_pdf(
-    invoice_id: str,
-    authorization: Optional[str] = Header(None)
-):
-    """Serve PDF file from GCS for an invoice"""
-    await verify_token(authorization)
+@functools.lru_cache(maxsize=64)
+def get_bucket(bucket_name):
+    """Bucket handles are reused across requests, PDFs live in a handful of buckets"""
+    return storage_client.bucket(bucket_name)
+
+
+# Worker threads signing at once share one token refresh
+signing_lock = threading.Lock()
+
+
+def signed_pdf_url(blob, disposition):
+    """V4 signed GET URL so GCS serves the PDF to the browser directly"""
+    signing_kwargs = {}
+    if not isinstance(gcp_credentials, google.auth.credentials.Signing):
+        # Token-only credentials (Cloud Run metadata server) sign through IAM signBlob
+        with signing_lock:
+            if not gcp_credentials.valid:
+                gcp_credentials.refresh(google.auth.transport.requests.Request())
+            signing_kwargs = {
+                "service_account_email": gcp_credentials.service_account_email,
+                "access_token": gcp_credentials.token
+            }
+    
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=PDF_URL_EXPIRATION,
+        method="GET",
+        response_type="application/pdf",
+        response_disposition=disposition,
+        **signing_kwargs
+    )
+
+
+def pdf_exists(gcs_uri, blob):
+    """blob.exists() costs a GCS round trip; a PDF once found is remembered as long as its gcs_uri"""
+    with gcs_uri_lock:
+        if gcs_uri in pdf_exists_cache:
+            return True
+    
+    if not blob.exists():
+        return False
+    
+    with gcs_uri_lock:
+        pdf_exists_cache[gcs_uri] = True
+    return True
+
+
+def pdf_response(gcs_uri, download=False):
+    """Redirect to a signed URL for the PDF, proxying the bytes only when signing is unavailable"""
+    # Parse GCS URI: gs://bucket-name/path/to/file.pdf
+    if not gcs_uri.startswith('gs://'):
+        raise HTTPException(status_code=400, detail="Invalid GCS URI")
+    
+    gcs_path = gcs_uri[5:]  # Remove 'gs://' prefix
+    bucket_name, blob_path = gcs_path.split('/', 1)
+    filename = blob_path.split("/")[-1]
+    # Quoted ASCII fallback with quotes/backslashes dropped, exact name percent-encoded in filename*
+    fallback_filename = filename.encode("ascii", "replace").decode().translate(DISPOSITION_STRIP)
+    disposition = (
+        f'{"attachment" if download else "inline"}; '
+        f'filename="{fallback_filename}"; filename*=UTF-8\'\'{urllib.parse.quote(filename, safe="")}'
+    )
+    
+    blob = get_bucket(bucket_name).blob(blob_path)
+    
+    try:
+        signed_url = signed_pdf_url(blob, disposition)
+    except (AttributeError, google.auth.exceptions.GoogleAuthError) as e:
+        # e.g. local user credentials with no service account to sign with
+        print(f"Signed URL unavailable, proxying PDF: {str(e)}")
+    else:
+        # A signed URL to a missing object would send the browser a GCS XML error instead of our 404
+        if not pdf_exists(gcs_uri, blob):
+            raise HTTPException(status_code=404, detail="PDF file not found in GCS")
+        return RedirectResponse(signed_url, status_code=302)
+    
+    # Stream the file from GCS in chunks; the first read raises NotFound for a missing object
+    reader = blob.open("rb", chunk_size=PDF_CHUNK_SIZE)
+    try:
+        first_chunk = reader.read(PDF_CHUNK_SIZE)
+    except NotFound:
+        reader.close()
+        raise HTTPException(status_code=404, detail="PDF file not found in GCS")
+    
+    def iter_chunks():
+        with reader:
+            chunk = first_chunk
+            while chunk:
+                yield chunk
+                chunk = reader.read(PDF_CHUNK_SIZE)
+    
+    return StreamingResponse(
+        iter_chunks(),
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": disposition
+        }
+    )
+
+
+def resolve_gcs_uri(table, id_column, id_value, not_found_detail):
+    """Get GCS URI for a row from BigQuery, cached for a few minutes so repeat PDF views skip the query"""
+    key = (table, id_value)
+    with gcs_uri_lock:
+        if key in gcs_uri_cache:
+            return gcs_uri_cache[key]
     
-    # Get GCS URI from BigQuery
     query = f"""
     SELECT gcs_uri
-    FROM `{project_id}.{dataset_id}.invoices_processed`
-    WHERE invoice_id = @invoice_id
+    FROM `{project_id}.{dataset_id}.{table}`
+    WHERE {id_column} = @id_value
     LIMIT 1
     """
     
     job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("invoice_id", "STRING", invoice_id)
-        ]
+        query_parameters=scalar_params(id_value=id_value)
     )
     
+    results = list(bq_client.query_and_wait(query, job_config=job_config))
+    
+    # Unknown ids are not cached, they are looked up again next time
+    if not results:
+        raise HTTPException(status_code=404, detail=not_found_detail)
+    
+    gcs_uri = results[0].gcs_uri
+    with gcs_uri_lock:
+        gcs_uri_cache[key] = gcs_uri
+    return gcs_uri
+
+
+@app.get("/api/invoices/{invoice_id}/pdf")
+async def get_invoice_pdf(
+    invoice_id: str,
+    download: bool = Query(False),
+    user: dict = Depends(verify_token)
+):
+    """Serve PDF file from GCS for an invoice"""
     try:
-        query_job = bq_client.query(query, job_config=job_config)
-        results = list(query_job.result())
-        
-        if not results:
-            raise HTTPException(status_code=404, detail="Invoice not found")
-        
-        gcs_uri = results[0].gcs_uri
+        gcs_uri = await asyncio.to_thread(
+            resolve_gcs_uri, "invoices_processed", "invoice_id", invoice_id, "Invoice not found"
+        )
         if not gcs_uri:
             raise HTTPException(status_code=404, detail="PDF not found for this invoice")
         
-        # Parse GCS URI: gs://bucket-name/path/to/file.pdf
-        if not gcs_uri.startswith('gs://'):
-            raise HTTPException(status_code=400, detail="Invalid GCS URI")
-        
-        gcs_path = gcs_uri[5:]  # Remove 'gs://' prefix
-        bucket_name, blob_path = gcs_path.split('/', 1)
-        
-        # Get file from GCS
-        storage_client = storage.Client(project=project_id)
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_path)
-        
-        if not blob.exists():
-            raise HTTPException(status_code=404, detail="PDF file not found in GCS")
-        
-        # Download file from GCS and return it
-        file_content = blob.download_as_bytes()
-        
-        return StreamingResponse(
-            iter([file_content]),
-            media_type="application/pdf",
-            headers={
-                "Content-Disposition": f'inline; filename="{blob_path.split("/")[-1]}"'
-            }
-        )
+        return await asyncio.to_thread(pdf_response, gcs_uri, download)
         
     except HTTPException:
         raise
@@ -441,17 +776,79 @@ async def get_invoice_pdf(
         raise HTTPException(status_code=500, detail=f"Failed to retrieve PDF: {str(e)}")
 
 
+# Storage Write API append streams per table; row layouts live in bq_rows.py
+write_streams = {}
+# Reentrant: a stream that fails while being opened can run its close callback in the opening thread
+write_streams_lock = threading.RLock()
+
+
+def _open_write_stream(table):
+    """Long-lived append stream on the table's default write stream"""
+    _, message_proto = row_type(table)
+    request_template = bqs_types.AppendRowsRequest(
+        write_stream=f"{bq_write_client.table_path(project_id, dataset_id, table)}/streams/_default",
+        proto_rows=bqs_types.AppendRowsRequest.ProtoData(
+            writer_schema=bqs_types.ProtoSchema(proto_descriptor=message_proto)
+        )
+    )
+    stream = bqs_writer.AppendRowsStream(bq_write_client, request_template)
+    # Idle streams get closed by the server; drop them so the next write reopens
+    stream.add_close_callback(lambda closed, reason: _forget_write_stream(table, closed))
+    return stream
+
+
+def _forget_write_stream(table, stream):
+    """Drop a closed stream, unless it has already been replaced by a newer one"""
+    with write_streams_lock:
+        if write_streams.get(table) is stream:
+            del write_streams[table]
+
+
+def _send_row_request(table, request):
+    """Send on the table's current stream, opening one if there is none"""
+    with write_streams_lock:
+        stream = write_streams.get(table)
+        if stream is None:
+            stream = write_streams[table] = _open_write_stream(table)
+        try:
+            return stream, stream.send(request)
+        except StreamClosedError:
+            _forget_write_stream(table, stream)
+            raise
+
+
+def append_row(table, row):
+    """Append one row over the BigQuery Storage Write API and wait for the ack"""
+    row_class, _ = row_type(table)
+    message = row_class(**{name: value for name, value in row.items() if value is not None})
+    request = bqs_types.AppendRowsRequest(
+        proto_rows=bqs_types.AppendRowsRequest.ProtoData(
+            rows=bqs_types.ProtoRows(serialized_rows=[message.SerializeToString()])
+        )
+    )
+    
+    stream = None
+    try:
+        stream, future = _send_row_request(table, request)
+        future.result()
+    except StreamClosedError:
+        # The server closed the stream (e.g. idle timeout) before or during this append:
+        # retire it and send once more on a fresh one
+        if stream is not None:
+            _forget_write_stream(table, stream)
+        _, future = _send_row_request(table, request)
+        future.result()
+
+
 @app.post("/api/test/write-to-bq")
 async def write_to_bigquery(
     request: dict,
-    authorization: Optional[str] = Header(None)
+    user: dict = Depends(verify_token)
 ):
     """
     Test endpoint to write invoice data to BigQuery
     This writes to either invoices_processed or exceptions table based on validation result
     """
-    await verify_token(authorization)
-    
     try:
         message_id = request.get("message_id")
         filename = request.get("filename")
@@ -474,65 +871,52 @@ async def write_to_bigquery(
         total_tax_amount = extracted_data.get("total_tax_amount")
         currency = extracted_data.get("currency")
         
+        # Storage Write API stores DATE as days since epoch, TIMESTAMP as epoch micros
+        today = (datetime.now(timezone.utc).date() - EPOCH_DATE).days
+        invoice_days = (date.fromisoformat(invoice_date) - EPOCH_DATE).days if invoice_date else None
+        
         if is_exception and len(exceptions) > 0:
             # Write to exceptions table
-            exception_id = f"{message_id}-{filename}"
-            exception_type = exceptions[0].get("type", "VALIDATION_ERROR")
-            exception_severity = exceptions[0].get("severity", "medium")
-            
-            query = f"""
-            INSERT INTO `{project_id}.{dataset_id}.exceptions`
-            (exception_id, invoice_id, message_id, filename, gcs_uri, received_date, invoice_date, supplier_name, total_amount, exception_type, exception_severity, all_exceptions, status, raw_extracted_data, created_at)
-            VALUES (@exception_id, @invoice_id, @message_id, @filename, @gcs_uri, CURRENT_DATE(), @invoice_date, @supplier_name, @total_amount, @exception_type, @exception_severity, @all_exceptions, 'PENDING', @raw_extracted_data, CURRENT_TIMESTAMP())
-            """
-            
-            job_config = bigquery.QueryJobConfig(
-                query_parameters=[
-                    bigquery.ScalarQueryParameter("exception_id", "STRING", exception_id),
-                    bigquery.ScalarQueryParameter("invoice_id", "STRING", invoice_id),
-                    bigquery.ScalarQueryParameter("message_id", "STRING", message_id),
-                    bigquery.ScalarQueryParameter("filename", "STRING", filename),
-                    bigquery.ScalarQueryParameter("gcs_uri", "STRING", gcs_uri),
-                    bigquery.ScalarQueryParameter("invoice_date", "DATE", invoice_date if invoice_date else None),
-                    bigquery.ScalarQueryParameter("supplier_name", "STRING", supplier_name),
-                    bigquery.ScalarQueryParameter("total_amount", "FLOAT64", float(total_amount) if total_amount else None),
-                    bigquery.ScalarQueryParameter("exception_type", "STRING", exception_type),
-                    bigquery.ScalarQueryParameter("exception_severity", "STRING", exception_severity),
-                    bigquery.ScalarQueryParameter("all_exceptions", "JSON", json.dumps(exceptions)),
-                    bigquery.ScalarQueryParameter("raw_extracted_data", "JSON", json.dumps(extracted_data))
-                ]
-            )
-            
             table_name = "exceptions"
+            row = {
+                "exception_id": f"{message_id}-{filename}",
+                "invoice_id": invoice_id,
+                "message_id": message_id,
+                "filename": filename,
+                "gcs_uri": gcs_uri,
+                "received_date": today,
+                "invoice_date": invoice_days,
+                "supplier_name": supplier_name,
+                "total_amount": float(total_amount) if total_amount else None,
+                "exception_type": exceptions[0].get("type", "VALIDATION_ERROR"),
+                "exception_severity": exceptions[0].get("severity", "medium"),
+                "all_exceptions": orjson.dumps(exceptions).decode(),
+                "status": "PENDING",
+                "raw_extracted_data": orjson.dumps(extracted_data).decode(),
+                "created_at": int(datetime.now(timezone.utc).timestamp() * 1_000_000)
+            }
         else:
             # Write to invoices_processed table
-            query = f"""
-            INSERT INTO `{project_id}.{dataset_id}.invoices_processed`
-            (invoice_id, message_id, filename, gcs_uri, received_date, invoice_date, supplier_name, total_amount, net_amount, total_tax_amount, currency, raw_extracted_data)
-            VALUES (@invoice_id, @message_id, @filename, @gcs_uri, CURRENT_DATE(), @invoice_date, @supplier_name, @total_amount, @net_amount, @total_tax_amount, @currency, @raw_extracted_data)
-            """
-            
-            job_config = bigquery.QueryJobConfig(
-                query_parameters=[
-                    bigquery.ScalarQueryParameter("invoice_id", "STRING", invoice_id),
-                    bigquery.ScalarQueryParameter("message_id", "STRING", message_id),
-                    bigquery.ScalarQueryParameter("filename", "STRING", filename),
-                    bigquery.ScalarQueryParameter("gcs_uri", "STRING", gcs_uri),
-                    bigquery.ScalarQueryParameter("invoice_date", "DATE", invoice_date if invoice_date else None),
-                    bigquery.ScalarQueryParameter("supplier_name", "STRING", supplier_name),
-                    bigquery.ScalarQueryParameter("total_amount", "FLOAT64", float(total_amount) if total_amount else None),
-                    bigquery.ScalarQueryParameter("net_amount", "FLOAT64", float(net_amount) if net_amount else None),
-                    bigquery.ScalarQueryParameter("total_tax_amount", "FLOAT64", float(total_tax_amount) if total_tax_amount else None),
-                    bigquery.ScalarQueryParameter("currency", "STRING", currency),
-                    bigquery.ScalarQueryParameter("raw_extracted_data", "JSON", json.dumps(extracted_data))
-                ]
-            )
-            
             table_name = "invoices_processed"
+            row = {
+                "invoice_id": invoice_id,
+                "message_id": message_id,
+                "filename": filename,
+                "gcs_uri": gcs_uri,
+                "received_date": today,
+                "invoice_date": invoice_days,
+                "supplier_name": supplier_name,
+                "total_amount": float(total_amount) if total_amount else None,
+                "net_amount": float(net_amount) if net_amount else None,
+                "total_tax_amount": float(total_tax_amount) if total_tax_amount else None,
+                "currency": currency,
+                "raw_extracted_data": orjson.dumps(extracted_data).decode()
+            }
         
-        # Execute the query
-        query_job = bq_client.query(query, job_config=job_config)
-        query_job.result()  # Wait for completion
+        # Stream the row in instead of running an INSERT job
+        await asyncio.to_thread(append_row, table_name, row)
+        if table_name == "exceptions":
+            invalidate_exception_caches(row["exception_id"])
         
         return {
             "status": "success",
@@ -558,19 +942,15 @@ async def get_invoice_comments(invoice_id: str):
         """
         
         job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("invoice_id", "STRING", invoice_id)
-            ]
+            query_parameters=scalar_params(invoice_id=invoice_id)
         )
         
-        query_job = bq_client.query(query, job_config=job_config)
-        results = query_job.result()
+        results = await run_query(query, job_config)
         
         for row in results:
             if row.comments:
                 # Parse JSON string to list
-                import json
-                return json.loads(row.comments) if isinstance(row.comments, str) else row.comments
+                return orjson.loads(row.comments) if isinstance(row.comments, str) else row.comments
         
         return []  # No comments found
         
@@ -582,9 +962,6 @@ async def get_invoice_comments(invoice_id: str):
 async def add_invoice_comment(invoice_id: str, comment: dict):
     """Add a comment to the invoice's comments JSON array"""
     try:
-        import uuid
-        from datetime import datetime, timezone
-        import json
         
         comment_id = str(uuid.uuid4())
         created_by = comment.get("created_by", "QA Engineer")
@@ -601,47 +978,21 @@ async def add_invoice_comment(invoice_id: str, comment: dict):
             "status": "ACTIVE"
         }
         
-        # Get existing comments
-        query_get = f"""
-        SELECT comments
-        FROM `{project_id}.{dataset_id}.invoices_processed`
-        WHERE invoice_id = @invoice_id
-        """
-        
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("invoice_id", "STRING", invoice_id)
-            ]
-        )
-        
-        query_job = bq_client.query(query_get, job_config=job_config)
-        results = query_job.result()
-        
-        existing_comments = []
-        for row in results:
-            if row.comments:
-                existing_comments = json.loads(row.comments) if isinstance(row.comments, str) else row.comments
-                break
-        
-        # Add new comment
-        existing_comments.append(new_comment)
-        comments_json_str = json.dumps(existing_comments)
-        
-        # Update with new comments array - use PARSE_JSON instead of JSON type
+        # Append server-side: one job, and no lost update between a read and a write
         query_update = f"""
         UPDATE `{project_id}.{dataset_id}.invoices_processed`
-        SET comments = PARSE_JSON(@comments)
+        SET comments = JSON_ARRAY_APPEND(IFNULL(comments, JSON '[]'), '$', PARSE_JSON(@new_comment))
         WHERE invoice_id = @invoice_id
         """
         
         job_config_update = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("invoice_id", "STRING", invoice_id),
-                bigquery.ScalarQueryParameter("comments", "STRING", comments_json_str)
-            ]
+            query_parameters=scalar_params(
+                invoice_id=invoice_id,
+                new_comment=orjson.dumps(new_comment).decode()
+            )
         )
         
-        bq_client.query(query_update, job_config=job_config_update).result()
+        await run_query(query_update, job_config_update)
         
         return {
             "success": True,
@@ -651,7 +1002,6 @@ async def add_invoice_comment(invoice_id: str, comment: dict):
         
     except Exception as e:
         print(f"Error adding comment: {str(e)}")
-        import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -659,155 +1009,80 @@ async def add_invoice_comment(invoice_id: str, comment: dict):
 async def delete_comment(invoice_id: str, comment_id: str):
     """Mark a comment as deleted in the comments JSON array"""
     try:
-        import json
-        
-        # Get existing comments
-        query_get = f"""
-        SELECT comments
-        FROM `{project_id}.{dataset_id}.invoices_processed`
-        WHERE invoice_id = @invoice_id
-        """
-        
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("invoice_id", "STRING", invoice_id)
-            ]
-        )
-        
-        query_job = bq_client.query(query_get, job_config=job_config)
-        results = query_job.result()
-        
-        existing_comments = []
-        for row in results:
-            if row.comments:
-                existing_comments = json.loads(row.comments) if isinstance(row.comments, str) else row.comments
-                break
         
-        # Mark comment as deleted
-        for comment in existing_comments:
-            if comment.get("comment_id") == comment_id:
-                comment["status"] = "DELETED"
-        
-        comments_json_str = json.dumps(existing_comments)
-        
-        # Update comments - use PARSE_JSON
+        # Flip the status server-side: one job, and no lost update between a read and a write
         query_update = f"""
         UPDATE `{project_id}.{dataset_id}.invoices_processed`
-        SET comments = PARSE_JSON(@comments)
-        WHERE invoice_id = @invoice_id
+        SET comments = TO_JSON(ARRAY(
+          SELECT IF(JSON_VALUE(c, '$.comment_id') = @comment_id, JSON_SET(c, '$.status', 'DELETED'), c)
+          FROM UNNEST(JSON_QUERY_ARRAY(comments)) c WITH OFFSET pos
+          ORDER BY pos
+        ))
+        WHERE invoice_id = @invoice_id AND comments IS NOT NULL
         """
         
         job_config_update = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("invoice_id", "STRING", invoice_id),
-                bigquery.ScalarQueryParameter("comments", "STRING", comments_json_str)
-            ]
+            query_parameters=scalar_params(
+                invoice_id=invoice_id,
+                comment_id=comment_id
+            )
         )
         
-        bq_client.query(query_update, job_config=job_config_update).result()
+        await run_query(query_update, job_config_update)
         
         return {"success": True, "message": "Comment deleted"}
         
     except Exception as e:
         print(f"Error deleting comment: {str(e)}")
-        import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/exceptions/{exception_id}/pdf")
 async def get_exception_pdf(
     exception_id: str,
-    authorization: Optional[str] = Header(None)
+    download: bool = Query(False),
+    user: dict = Depends(verify_token)
 ):
     """Serve PDF file from GCS for an exception"""
-    await verify_token(authorization)
-    
-    # Get GCS URI from BigQuery exceptions table
-    query = f"""
-    SELECT gcs_uri
-    FROM `{project_id}.{dataset_id}.exceptions`
-    WHERE exception_id = @exception_id
-    LIMIT 1
-    """
-    
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("exception_id", "STRING", exception_id)
-        ]
-    )
-    
     try:
-        query_job = bq_client.query(query, job_config=job_config)
-        results = list(query_job.result())
-        
-        if not results:
-            raise HTTPException(status_code=404, detail="Exception not found")
-        
-        gcs_uri = results[0].gcs_uri
+        gcs_uri = await asyncio.to_thread(
+            resolve_gcs_uri, "exceptions", "exception_id", exception_id, "Exception not found"
+        )
         if not gcs_uri:
             raise HTTPException(status_code=404, detail="PDF not found for this exception")
         
-        # Parse GCS URI: gs://bucket-name/path/to/file.pdf
-        if not gcs_uri.startswith('gs://'):
-            raise HTTPException(status_code=400, detail="Invalid GCS URI")
-        
-        gcs_path = gcs_uri[5:]  # Remove 'gs://' prefix
-        bucket_name, blob_path = gcs_path.split('/', 1)
-        
-        # Get file from GCS
-        storage_client = storage.Client(project=project_id)
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_path)
-        
-        if not blob.exists():
-            raise HTTPException(status_code=404, detail="PDF file not found in GCS")
-        
-        # Download file from GCS and return it
-        file_content = blob.download_as_bytes()
-        
-        return StreamingResponse(
-            iter([file_content]),
-            media_type="application/pdf",
-            headers={
-                "Content-Disposition": f'inline; filename="{blob_path.split("/")[-1]}"'
-            }
-        )
+        return await asyncio.to_thread(pdf_response, gcs_uri, download)
         
     except HTTPException:
         raise
     except Exception as e:
         print(f"Error retrieving PDF: {str(e)}")
-        import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Failed to retrieve PDF: {str(e)}")
 
 @app.get("/api/exceptions/{exception_id}/comments")
 async def get_exception_comments(exception_id: str):
-    """Get comments for an exception from the comments JSON column"""
+    """Get the active comments for an exception from exception_comments"""
     try:
         query = f"""
-        SELECT comments
-        FROM `{project_id}.{dataset_id}.exceptions`
-        WHERE exception_id = @exception_id
+        SELECT
+            comment_id,
+            FORMAT_TIMESTAMP('%Y-%m-%dT%H:%M:%E6S%Ez', created_at) as created_at,
+            created_by,
+            comment_text,
+            status
+        FROM `{project_id}.{dataset_id}.exception_comments`
+        WHERE exception_id = @exception_id AND status = 'ACTIVE'
+        ORDER BY created_at
         """
         
         job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("exception_id", "STRING", exception_id)
-            ]
+            query_parameters=scalar_params(exception_id=exception_id)
         )
         
-        query_job = bq_client.query(query, job_config=job_config)
-        results = query_job.result()
+        results = await run_query(query, job_config)
         
-        for row in results:
-            if row.comments:
-                # Parse JSON and filter out deleted comments
-                comments = json.loads(row.comments) if isinstance(row.comments, str) else row.comments
-                # Only return ACTIVE comments
-                return [c for c in comments if c.get("status") == "ACTIVE"]
-        
-        return []  # No comments found
+        return [dict(row.items()) for row in results]
         
     except Exception as e:
         print(f"Error getting comments: {str(e)}")
@@ -816,9 +1091,8 @@ async def get_exception_comments(exception_id: str):
 
 @app.post("/api/exceptions/{exception_id}/comments")
 async def add_exception_comment(exception_id: str, comment: dict):
-    """Add a comment to the exception's comments JSON array"""
+    """Add a comment row to exception_comments"""
     try:
-        from datetime import datetime, timezone
         
         comment_id = str(uuid.uuid4())
         created_by = comment.get("created_by", "QA Engineer")
@@ -827,55 +1101,23 @@ async def add_exception_comment(exception_id: str, comment: dict):
         if not comment_text:
             raise HTTPException(status_code=400, detail="Comment text is required")
         
-        new_comment = {
-            "comment_id": comment_id,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "created_by": created_by,
-            "comment_text": comment_text,
-            "status": "ACTIVE"
-        }
-        
-        # Get existing comments
-        query_get = f"""
-        SELECT comments
-        FROM `{project_id}.{dataset_id}.exceptions`
-        WHERE exception_id = @exception_id
+        # Append-only child table, like exception_reviews: one INSERT, no rewrite of the exceptions row
+        query_insert = f"""
+        INSERT INTO `{project_id}.{dataset_id}.exception_comments`
+        (comment_id, exception_id, created_at, created_by, comment_text, status)
+        VALUES (@comment_id, @exception_id, CURRENT_TIMESTAMP(), @created_by, @comment_text, 'ACTIVE')
         """
         
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("exception_id", "STRING", exception_id)
-            ]
-        )
-        
-        query_job = bq_client.query(query_get, job_config=job_config)
-        results = query_job.result()
-        
-        existing_comments = []
-        for row in results:
-            if row.comments:
-                existing_comments = json.loads(row.comments) if isinstance(row.comments, str) else row.comments
-                break
-        
-        # Add new comment
-        existing_comments.append(new_comment)
-        comments_json_str = json.dumps(existing_comments)
-        
-        # Update with new comments array
-        query_update = f"""
-        UPDATE `{project_id}.{dataset_id}.exceptions`
-        SET comments = PARSE_JSON(@comments)
-        WHERE exception_id = @exception_id
-        """
-        
-        job_config_update = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("exception_id", "STRING", exception_id),
-                bigquery.ScalarQueryParameter("comments", "STRING", comments_json_str)
-            ]
+        job_config_insert = bigquery.QueryJobConfig(
+            query_parameters=scalar_params(
+                comment_id=comment_id,
+                exception_id=exception_id,
+                created_by=created_by,
+                comment_text=comment_text
+            )
         )
         
-        bq_client.query(query_update, job_config=job_config_update).result()
+        await run_query(query_insert, job_config_insert)
         
         return {
             "success": True,
@@ -885,71 +1127,47 @@ async def add_exception_comment(exception_id: str, comment: dict):
         
     except Exception as e:
         print(f"Error adding comment: {str(e)}")
-        import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.delete("/api/exceptions/{exception_id}/comments/{comment_id}")
 async def delete_exception_comment(exception_id: str, comment_id: str):
-    """Mark a comment as deleted in the comments JSON array"""
+    """Mark a comment as deleted in exception_comments"""
     try:
-        # Get existing comments
-        query_get = f"""
-        SELECT comments
-        FROM `{project_id}.{dataset_id}.exceptions`
-        WHERE exception_id = @exception_id
-        """
-        
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("exception_id", "STRING", exception_id)
-            ]
-        )
-        
-        query_job = bq_client.query(query_get, job_config=job_config)
-        results = query_job.result()
-        
-        existing_comments = []
-        for row in results:
-            if row.comments:
-                existing_comments = json.loads(row.comments) if isinstance(row.comments, str) else row.comments
-                break
-        
-        # Mark comment as deleted
-        for comment in existing_comments:
-            if comment.get("comment_id") == comment_id:
-                comment["status"] = "DELETED"
-        
-        comments_json_str = json.dumps(existing_comments)
-        
-        # Update comments
         query_update = f"""
-        UPDATE `{project_id}.{dataset_id}.exceptions`
-        SET comments = PARSE_JSON(@comments)
-        WHERE exception_id = @exception_id
+        UPDATE `{project_id}.{dataset_id}.exception_comments`
+        SET status = 'DELETED'
+        WHERE exception_id = @exception_id AND comment_id = @comment_id
         """
         
         job_config_update = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("exception_id", "STRING", exception_id),
-                bigquery.ScalarQueryParameter("comments", "STRING", comments_json_str)
-            ]
+            query_parameters=scalar_params(
+                exception_id=exception_id,
+                comment_id=comment_id
+            )
         )
         
-        bq_client.query(query_update, job_config=job_config_update).result()
+        await run_query(query_update, job_config_update)
         
         return {"success": True, "message": "Comment deleted"}
         
     except Exception as e:
         print(f"Error deleting comment: {str(e)}")
-        import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    print(f"Starting server on port {port}")
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    print(f"Starting server on port {port} with {workers} workers")
     print(f"Auth enabled: {USE_AUTH}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=workers
+    )
\ No newline at end of file
@@ -3,12 +3,44 @@ Document AI Processor Cloud Function
 Extracts structured data from PDFs using Document AI
 """
 import functions_framework
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import msgpack
 import os
+import traceback
 from google.cloud import documentai_v1 as documentai
-from google.cloud import storage
 import json
 
 
+# Max Document AI requests one batch call keeps in flight
+BATCH_CONCURRENCY = int(os.getenv('DOCUMENT_AI_BATCH_CONCURRENCY', 10))
+
+# Documents per batch request before the function risks timing out
+MAX_BATCH_SIZE = int(os.getenv('DOCUMENT_AI_MAX_BATCH_SIZE', 50))
+
+# Currency symbol and thousands separators dropped before parsing a price
+PRICE_STRIP = str.maketrans('', '', '$,')
+
+
+def parse_price(value):
+    """'$1,234.50' -> 1234.5"""
+    return float(value.translate(PRICE_STRIP))
+
+
+# Document AI line_item property type -> (line item key, parser or None to keep the text)
+LINE_ITEM_PROPERTIES = {
+    "line_item/description": ("description", None),
+    "description": ("description", None),
+    "line_item/quantity": ("quantity", float),
+    "quantity": ("quantity", float),
+    "line_item/unit_price": ("unit_price", parse_price),
+    "unit_price": ("unit_price", parse_price),
+    "line_item/amount": ("unit_price", parse_price),
+    "line_item/product_code": ("product_code", None),
+    "product_code": ("product_code", None)
+}
+
+
 def load_confidence_thresholds():
     """Load confidence thresholds from config"""
     return {
@@ -21,6 +53,14 @@ def load_confidence_thresholds():
     }
 
 
+@functools.lru_cache(maxsize=None)
+def get_documentai_client(location):
+    """One client (and gRPC channel) per location, reused across warm invocations"""
+    return documentai.DocumentProcessorServiceClient(
+        client_options={"api_endpoint": f"{location}-documentai.googleapis.com"}
+    )
+
+
 def process_document_ai(project_id, location, processor_id, gcs_uri):
     """
     Process document using Document AI
@@ -28,30 +68,20 @@ def process_document_ai(project_id, location, processor_id, gcs_uri):
     Returns:
         dict with extracted entities and confidence scores
     """
-    # Initialize Document AI client
-    client = documentai.DocumentProcessorServiceClient()
+    client = get_documentai_client(location)
     
     # Resource name
     name = client.processor_path(project_id, location, processor_id)
     
-    # Read document from GCS
-    storage_client = storage.Client()
-    bucket_name = gcs_uri.replace('gs://', '').split('/')[0]
-    blob_path = '/'.join(gcs_uri.replace('gs://', '').split('/')[1:])
-    
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_path)
-    document_content = blob.download_as_bytes()
-    
-    # Configure request
-    raw_document = documentai.RawDocument(
-        content=document_content,
+    # Document AI reads the PDF straight from GCS, no download through this function
+    gcs_document = documentai.GcsDocument(
+        gcs_uri=gcs_uri,
         mime_type='application/pdf'
     )
     
     request = documentai.ProcessRequest(
         name=name,
-        raw_document=raw_document
+        gcs_document=gcs_document
     )
     
     # Process document
@@ -83,23 +113,19 @@ def process_document_ai(project_id, location, processor_id, gcs_uri):
             
             # Try to extract structured properties
             for prop in entity.properties:
-                prop_type = prop.type_
-                prop_value = prop.mention_text
+                target = LINE_ITEM_PROPERTIES.get(prop.type_)
+                if target is None:
+                    continue
                 
-                if prop_type in ["line_item/description", "description"]:
-                    line_item_data["description"] = prop_value
-                elif prop_type in ["line_item/quantity", "quantity"]:
-                    try:
-                        line_item_data["quantity"] = float(prop_value)
-                    except:
-                        line_item_data["quantity"] = prop_value
-                elif prop_type in ["line_item/unit_price", "unit_price", "line_item/amount"]:
+                key, parse = target
+                prop_value = prop.mention_text
+                if parse is None:
+                    line_item_data[key] = prop_value
+                else:
                     try:
-                        line_item_data["unit_price"] = float(prop_value.replace('$', '').replace(',', ''))
-                    except:
-                        line_item_data["unit_price"] = prop_value
-                elif prop_type in ["line_item/product_code", "product_code"]:
-                    line_item_data["product_code"] = prop_value
+                        line_item_data[key] = parse(prop_value)
+                    except ValueError:
+                        line_item_data[key] = prop_value
             
             line_items.append(line_item_data)
         else:
@@ -117,6 +143,48 @@ def process_document_ai(project_id, location, processor_id, gcs_uri):
     return extracted_data
 
 
+def process_invoice(gcs_uri):
+    """Run Document AI on one PDF and build the response payload for it"""
+    # Get configuration
+    project_id = os.getenv('GCP_PROJECT_ID')
+    location = os.getenv('DOCUMENT_AI_LOCATION', 'us')
+    processor_id = os.getenv('DOCUMENT_AI_PROCESSOR_ID')
+    
+    # Process document
+    result = process_document_ai(project_id, location, processor_id, gcs_uri)
+    
+    print(f"Extracted {len(result['entities'])} entities")
+    if 'line_items' in result['entities']:
+        print(f"Found {len(result['entities']['line_items'])} line items")
+    
+    # Load confidence thresholds
+    thresholds = load_confidence_thresholds()
+    
+    # Only fields Document AI was unsure about need another pass
+    needs_synthesis = []
+    for field, value in result["entities"].items():
+        confidence = result["confidence_scores"].get(field, 0.95)
+        threshold = thresholds.get(field, 0.95)
+        if value is not None and str(value).strip() and 0 < confidence < threshold:
+            needs_synthesis.append({
+                "field": field,
+                "confidence": confidence,
+                "threshold": threshold,
+                "current_value": value
+            })
+    
+    print(f"{len(needs_synthesis)} of {len(result['entities'])} fields below confidence threshold")
+    
+    return {
+        "status": "success",
+        "gcs_uri": gcs_uri,
+        "extracted_data": result["entities"],
+        "confidence_scores": result["confidence_scores"],
+        "needs_synthesis": needs_synthesis,
+        "raw_text_preview": result["raw_text"][:5000]  # Limit text preview
+    }
+
+
 @functions_framework.http
 def process_with_document_ai(request):
     """
@@ -147,46 +215,88 @@ def process_with_document_ai(request):
         
         print(f"Processing document: {gcs_uri}")
         
-        # Get configuration
-        project_id = os.getenv('GCP_PROJECT_ID')
-        location = os.getenv('DOCUMENT_AI_LOCATION', 'us')
-        processor_id = os.getenv('DOCUMENT_AI_PROCESSOR_ID')
+        response = process_invoice(gcs_uri)
+        
+        # Service callers can opt into msgpack; the workflow and browsers keep getting JSON
+        if "application/msgpack" in request.headers.get("Accept", ""):
+            return msgpack.packb(response, use_bin_type=True), 200, {"Content-Type": "application/msgpack"}
+        
+        return response
+        
+    except Exception as e:
+        print(f"Error in Document AI processing: {str(e)}")
+        traceback.print_exc()
+        return {
+            "status": "error",
+            "error": str(e)
+        }, 500
+
+
+def process_invoice_safely(gcs_uri):
+    """process_invoice for batch use: one bad PDF becomes an error entry instead of failing the batch"""
+    try:
+        return process_invoice(gcs_uri)
+    except Exception as e:
+        print(f"Error in Document AI processing for {gcs_uri}: {str(e)}")
+        traceback.print_exc()
+        return {
+            "status": "error",
+            "gcs_uri": gcs_uri,
+            "error": str(e)
+        }
+
+
+@functions_framework.http
+def process_batch_with_document_ai(request):
+    """
+    Cloud Function to process several documents with Document AI concurrently
+    
+    Expected request:
+    {
+        "gcs_uris": ["gs://bucket/a.pdf", "gs://bucket/b.pdf"]  (up to MAX_BATCH_SIZE)
+    }
+    
+    Returns:
+    {
+        "status": "success",
+        "results": [one process_with_document_ai payload per URI, in request order]
+    }
+    """
+    
+    try:
+        request_json = request.get_json()
+        gcs_uris = request_json.get('gcs_uris') or []
+        
+        if not gcs_uris:
+            return {'error': 'gcs_uris is required'}, 400
         
-        # Process document
-        result = process_document_ai(project_id, location, processor_id, gcs_uri)
+        if not isinstance(gcs_uris, list) or not all(isinstance(gcs_uri, str) for gcs_uri in gcs_uris):
+            return {'error': 'gcs_uris must be a list of strings'}, 400
         
-        print(f"Extracted {len(result['entities'])} entities")
-        if 'line_items' in result['entities']:
-            print(f"Found {len(result['entities']['line_items'])} line items")
+        if len(gcs_uris) > MAX_BATCH_SIZE:
+            return {'error': f'At most {MAX_BATCH_SIZE} gcs_uris per request'}, 400
         
-        # Load confidence thresholds
-        thresholds = load_confidence_thresholds()
+        print(f"Processing {len(gcs_uris)} documents")
         
-        # Send ALL extracted fields to Gemini for comprehensive extraction
-        needs_synthesis = []
-        for field, value in result["entities"].items():
-            if value is not None and str(value).strip():
-                needs_synthesis.append({
-                    "field": field,
-                    "confidence": result["confidence_scores"].get(field, 0.95),
-                    "threshold": thresholds.get(field, 0.95),
-                    "current_value": value
-                })
+        # Document AI calls are network-bound; the shared gRPC client is thread-safe.
+        # The cap keeps one batch inside the processor's request quota.
+        with ThreadPoolExecutor(max_workers=min(BATCH_CONCURRENCY, len(gcs_uris))) as executor:
+            results = list(executor.map(process_invoice_safely, gcs_uris))
         
-        return {
+        response = {
             "status": "success",
-            "gcs_uri": gcs_uri,
-            "extracted_data": result["entities"],
-            "confidence_scores": result["confidence_scores"],
-            "needs_synthesis": needs_synthesis,
-            "raw_text_preview": result["raw_text"][:5000]  # Limit text preview
+            "results": results
         }
         
+        if "application/msgpack" in request.headers.get("Accept", ""):
+            return msgpack.packb(response, use_bin_type=True), 200, {"Content-Type": "application/msgpack"}
+        
+        return response
+        
     except Exception as e:
-        print(f"Error in Document AI processing: {str(e)}")
-        import traceback
+        print(f"Error in Document AI batch processing: {str(e)}")
         traceback.print_exc()
         return {
             "status": "error",
             "error": str(e)
-        }, 500
\ No newline at end of file
+        }, 500
@@ -4,19 +4,67 @@ Fetches email details and attachments from Microsoft Graph API
 """
 import functions_framework
 import os
-import base64
+import io
 import json
 from google.cloud import storage
+import google.auth
+import google.auth.transport.requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import requests
+import requests.adapters
+from urllib3.util.retry import Retry
+import time
+import traceback
+
+
+# (tenant_id, client_id) -> {"token": ..., "expires_at": time.monotonic() deadline}
+TOKEN_CACHE = {}
+
+# Refetch this long before the token actually expires
+TOKEN_EXPIRY_MARGIN = 60
+
+# Concurrent GCS uploads per email
+MAX_PARALLEL_UPLOADS = 16
+
+# Only file attachments have a /$value to stream; item and reference attachments are rejected up front
+FILE_ATTACHMENT_TYPE = '#microsoft.graph.fileAttachment'
+
+# Resumable upload chunk (multiple of 256 KiB); bounds memory per in-flight attachment
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Clients live for the whole instance so warm invocations reuse their connections;
+# the GCS session's pool fits every parallel upload of one email
+gcp_credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+gcs_session = google.auth.transport.requests.AuthorizedSession(gcp_credentials)
+gcs_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_PARALLEL_UPLOADS))
+storage_client = storage.Client(credentials=gcp_credentials, _http=gcs_session)
+
+# Transient Graph/token-endpoint failures are retried here, with backoff and Retry-After,
+# instead of failing the whole email
+HTTP_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=['GET', 'POST'],
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+
+http = requests.Session()
+http.mount('https://', requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=HTTP_RETRY))
 
 
 def get_access_token():
-    """Get Microsoft Graph API access token"""
+    """Get Microsoft Graph API access token, reused across warm invocations until it nears expiry"""
     tenant_id = os.getenv('AZURE_TENANT_ID')
     client_id = os.getenv('AZURE_CLIENT_ID')
     client_secret = os.getenv('AZURE_CLIENT_SECRET')
     
+    cached = TOKEN_CACHE.get((tenant_id, client_id))
+    if cached and time.monotonic() < cached['expires_at']:
+        return cached['token']
+    
     url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
     
     data = {
@@ -26,14 +74,21 @@ def get_access_token():
         'grant_type': 'client_credentials'
     }
     
-    response = requests.post(url, data=data)
+    requested_at = time.monotonic()
+    response = http.post(url, data=data)
     response.raise_for_status()
     
-    return response.json()['access_token']
+    token_response = response.json()
+    TOKEN_CACHE[(tenant_id, client_id)] = {
+        'token': token_response['access_token'],
+        'expires_at': requested_at + int(token_response.get('expires_in', 0)) - TOKEN_EXPIRY_MARGIN
+    }
+    
+    return token_response['access_token']
 
 
 def get_email_details(access_token, user_email, message_id):
-    """Fetch email details including attachments"""
+    """Fetch email details and attachment metadata (content is streamed separately)"""
     url = f"https://graph.microsoft.com/v1.0/users/{user_email}/messages/{message_id}"
     
     headers = {
@@ -41,32 +96,139 @@ def get_email_details(access_token, user_email, message_id):
         'Content-Type': 'application/json'
     }
     
-    params = {'$expand': 'attachments'}
+    # Leave contentBytes out: base64 inside the JSON body would hold every attachment in memory twice
+    params = {'$expand': 'attachments($select=id,name,size)'}
     
-    response = requests.get(url, headers=headers, params=params)
+    response = http.get(url, headers=headers, params=params)
     response.raise_for_status()
     
     return response.json()
 
 
-def validate_pdf(filename):
-    """Check if file is a PDF"""
-    return filename.lower().endswith('.pdf')
+def open_attachment(access_token, user_email, message_id, attachment_id):
+    """Open the raw bytes of one attachment as a stream"""
+    url = f"https://graph.microsoft.com/v1.0/users/{user_email}/messages/{message_id}/attachments/{attachment_id}/$value"
+    
+    headers = {'Authorization': f'Bearer {access_token}'}
+    
+    response = http.get(url, headers=headers, stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True
+    
+    return response
+
+
+def validate_pdf(filename, head):
+    """Check if file is a PDF: .pdf name and the %PDF magic number at the start of the content"""
+    return filename.lower().endswith('.pdf') and head[:4] == b'%PDF'
 
 
-def upload_to_gcs(bucket_name, blob_path, content, content_type, metadata=None):
-    """Upload file to Google Cloud Storage"""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_path)
+def upload_to_gcs(bucket_name, blob_path, stream, content_type, metadata=None):
+    """
+    Upload a file-like stream to Google Cloud Storage
     
-    blob.upload_from_string(content, content_type=content_type)
+    Returns (gcs_uri, size in bytes)
+    """
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.blob(blob_path, chunk_size=UPLOAD_CHUNK_SIZE)
     
+    # Set before uploading so the metadata rides on the upload request instead of a follow-up patch()
     if metadata:
         blob.metadata = metadata
-        blob.patch()
     
-    return f"gs://{bucket_name}/{blob_path}"
+    # Size unknown up front, so this goes as a chunked resumable upload
+    blob.upload_from_file(stream, content_type=content_type)
+    
+    return f"gs://{bucket_name}/{blob_path}", blob.size
+
+
+def store_attachment(access_token, user_email, attachment, blob_name, message_id, upload_prefix, sender, subject, received_time, raw_bucket, rejected_bucket):
+    """
+    Stream one attachment from Graph to the raw bucket (PDFs) or the rejected bucket (anything else)
+    
+    Returns (accepted, file_info) for the processed_files/rejected_files lists
+    """
+    filename = attachment.get('name')
+    blob_path = f"{upload_prefix}/{blob_name}"
+    
+    with open_attachment(access_token, user_email, message_id, attachment['id']) as content:
+        # Buffered so the first bytes can be inspected without consuming them from the upload
+        stream = io.BufferedReader(content.raw)
+        
+        if not validate_pdf(filename, stream.peek(4)):
+            upload_to_gcs(
+                rejected_bucket,
+                blob_path,
+                stream,
+                'application/octet-stream',
+                metadata={
+                    'message_id': message_id,
+                    'sender': sender,
+                    'received_time': received_time
+                }
+            )
+            return False, {
+                "filename": filename,
+                "reason": "Invalid file format. Only PDF files are accepted."
+            }
+        
+        gcs_uri, size_bytes = upload_to_gcs(
+            raw_bucket,
+            blob_path,
+            stream,
+            'application/pdf',
+            metadata={
+                'message_id': message_id,
+                'sender': sender,
+                'subject': subject,
+                'received_time': received_time,
+                'original_filename': filename
+            }
+        )
+    
+    return True, {
+        "filename": filename,
+        "gcs_uri": gcs_uri,
+        "size_bytes": size_bytes
+    }
+
+
+def store_attachment_safely(access_token, user_email, attachment, blob_name, message_id, upload_prefix, sender, subject, received_time, raw_bucket, rejected_bucket):
+    """Store one attachment, reporting a failure as a rejected file instead of failing the whole email"""
+    if attachment.get('@odata.type') != FILE_ATTACHMENT_TYPE:
+        return False, {
+            "filename": attachment.get('name'),
+            "reason": "Not a file attachment."
+        }
+    
+    try:
+        return store_attachment(
+            access_token, user_email, attachment, blob_name, message_id, upload_prefix, sender, subject, received_time, raw_bucket, rejected_bucket
+        )
+    except Exception as e:
+        print(f"Error storing attachment {attachment.get('name')}: {str(e)}")
+        traceback.print_exc()
+        return False, {
+            "filename": attachment.get('name'),
+            "reason": f"Failed to store attachment: {str(e)}"
+        }
+
+
+def unique_blob_names(attachments):
+    """Attachment names as sent, with " (2)", " (3)", ... before the extension for repeats within one email"""
+    used = set()
+    blob_names = []
+    for attachment in attachments:
+        name = attachment.get('name') or 'attachment'
+        stem, extension = os.path.splitext(name)
+        blob_name = name
+        copy = 1
+        while blob_name in used:
+            copy += 1
+            blob_name = f"{stem} ({copy}){extension}"
+        used.add(blob_name)
+        blob_names.append(blob_name)
+    return blob_names
 
 
 @functions_framework.http
@@ -105,50 +267,25 @@ def process_email(request):
         raw_bucket = os.getenv('GCS_BUCKET_RAW')
         rejected_bucket = os.getenv('GCS_BUCKET_REJECTED')
         
-        for attachment in attachments:
-            filename = attachment.get('name')
-            content_bytes = base64.b64decode(attachment.get('contentBytes', ''))
-            
-            if not validate_pdf(filename):
-                rejected_files.append({
-                    "filename": filename,
-                    "reason": "Invalid file format. Only PDF files are accepted."
-                })
-                
-                blob_path = f"{message_id}/{datetime.utcnow().isoformat()}/{filename}"
-                upload_to_gcs(
-                    rejected_bucket,
-                    blob_path,
-                    content_bytes,
-                    'application/octet-stream',
-                    metadata={
-                        'message_id': message_id,
-                        'sender': sender,
-                        'received_time': received_time
-                    }
-                )
-                continue
-            
-            blob_path = f"{message_id}/{datetime.utcnow().isoformat()}/{filename}"
-            gcs_uri = upload_to_gcs(
-                raw_bucket,
-                blob_path,
-                content_bytes,
-                'application/pdf',
-                metadata={
-                    'message_id': message_id,
-                    'sender': sender,
-                    'subject': subject,
-                    'received_time': received_time,
-                    'original_filename': filename
-                }
-            )
-            
-            processed_files.append({
-                "filename": filename,
-                "gcs_uri": gcs_uri,
-                "size_bytes": len(content_bytes)
-            })
+        # All attachments of one email land under the same prefix
+        upload_prefix = f"{message_id}/{datetime.utcnow().isoformat()}"
+        
+        # Uploads are independent network round trips; run them side by side
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_UPLOADS) as executor:
+            results = list(executor.map(
+                lambda attachment, blob_name: store_attachment_safely(
+                    access_token, user_email, attachment, blob_name, message_id, upload_prefix, sender, subject, received_time, raw_bucket, rejected_bucket
+                ),
+                attachments,
+                # Same-named attachments would otherwise overwrite each other under the shared prefix
+                unique_blob_names(attachments)
+            ))
+        
+        for accepted, file_info in results:
+            if accepted:
+                processed_files.append(file_info)
+            else:
+                rejected_files.append(file_info)
         
         return {
             "status": "success",
@@ -161,6 +298,5 @@ def process_email(request):
         
     except Exception as e:
         print(f"Error: {str(e)}")
-        import traceback
         traceback.print_exc()
         return {"status": "error", "error": str(e)}, 500
\ No newline at end of file
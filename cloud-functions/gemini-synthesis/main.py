@@ -3,26 +3,78 @@ Gemini Synthesis Cloud Function
 Uses comprehensive prompt for complete invoice extraction
 """
 import functions_framework
+import functools
 import os
-import json
+import orjson
+import re
+import traceback
 import requests
+import requests.adapters
+from urllib3.util.retry import Retry
 import google.auth
 from google.auth.transport.requests import Request
 from google.cloud import storage
 import base64
+from concurrent.futures import ThreadPoolExecutor
 
 
-def get_access_token():
-    """Get access token"""
+# Longest Retry-After we will sleep for before retrying a Vertex call
+MAX_RETRY_AFTER = 20
+
+
+class CappedRetry(Retry):
+    """Retry that honours Retry-After only up to MAX_RETRY_AFTER seconds"""
+    
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER)
+
+
+# Vertex 429/5xx are retried once here with backoff (honouring a capped Retry-After),
+# reusing the already-built request body instead of failing the invocation. Read
+# timeouts are not retried: a slow generation replayed would keep billing Vertex after
+# the workflow (timeout 300s) has given up. Two 120s attempts plus the capped wait
+# stay inside that budget; connection failures never reached Vertex and are safe to retry.
+HTTP_RETRY = CappedRetry(
+    total=3,
+    connect=2,
+    read=0,
+    status=1,
+    other=0,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=['POST'],
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+
+# Shared for the life of the instance: keep-alive to the Vertex endpoint and one GCS client
+http = requests.Session()
+http.mount('https://', requests.adapters.HTTPAdapter(max_retries=HTTP_RETRY))
+storage_client = storage.Client()
+
+
+@functools.lru_cache(maxsize=1)
+def get_credentials():
+    """Default credentials, kept for the life of the instance so their token is reused"""
     credentials, project = google.auth.default(
         scopes=['https://www.googleapis.com/auth/cloud-platform']
     )
-    credentials.refresh(Request())
+    return credentials
+
+
+def get_access_token():
+    """Get access token, only hitting the metadata server when the cached one is near expiry"""
+    credentials = get_credentials()
+    # valid is False once the token is within google-auth's refresh margin of expiry
+    if not credentials.valid:
+        credentials.refresh(Request())
     return credentials.token
 
 
+@functools.lru_cache(maxsize=1)
 def load_extraction_prompt():
-    """Load the comprehensive extraction prompt"""
+    """Load the comprehensive extraction prompt (read once per instance)"""
     try:
         with open('INVOICE_EXTRACTION_PROMPT.md', 'r') as f:
             return f.read()
@@ -33,6 +85,63 @@ def load_extraction_prompt():
 Extract all invoice fields accurately including invoice number, date, supplier, customer, amounts, and line items."""
 
 
+# Field-improvement requests above this size are split into concurrent Gemini calls
+FIELDS_PER_SHARD = 4
+
+# Leading ```json / ``` and trailing ``` that Gemini wraps around JSON answers
+CODE_FENCE = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$')
+
+
+def strip_code_fence(text):
+    """Strip the markdown code fence (if any) around a model response"""
+    return CODE_FENCE.sub('', text).strip()
+
+
+COMPREHENSIVE_TASK = """## YOUR TASK
+1. Carefully review the PDF document provided
+2. Extract ALL invoice fields according to the comprehensive schema above
+3. Pay special attention to:
+   - **Line items**: Extract EVERY line item in the invoice table with all details
+   - **Amounts**: Remove currency symbols, ensure numeric values only
+   - **Dates**: Convert to MM/dd/yyyy format
+   - **Addresses**: Combine multi-line addresses into single formatted strings
+   - **Missing fields**: If Document AI missed fields, extract them now
+4. Return ONLY the JSON object with the exact field names from the schema
+5. Do NOT include markdown code blocks, explanations, or any extra text
+
+Output JSON:"""
+
+
+# Stands in for the PDF's base64 in the serialized request JSON
+PDF_PLACEHOLDER = '__PDF_BASE64__'
+
+# Raw PDF bytes base64-encoded per streamed chunk (multiple of 3, so chunks concatenate cleanly)
+PDF_ENCODE_CHUNK = 3 * 64 * 1024
+
+
+class PdfRequestBody:
+    """
+    Request JSON with the PDF's base64 encoded on the fly while it is sent
+    
+    Only the raw PDF bytes stay in memory, never a base64 string plus a body that embeds it.
+    Iterable (and re-iterable for HTTP retries) with a known length, so requests sends it
+    with a Content-Length instead of chunked encoding.
+    """
+    
+    def __init__(self, envelope, pdf_bytes):
+        self.head, self.tail = envelope.split(PDF_PLACEHOLDER.encode(), 1)
+        self.pdf = memoryview(pdf_bytes)
+    
+    def __len__(self):
+        return len(self.head) + 4 * ((len(self.pdf) + 2) // 3) + len(self.tail)
+    
+    def __iter__(self):
+        yield self.head
+        for start in range(0, len(self.pdf), PDF_ENCODE_CHUNK):
+            yield base64.b64encode(self.pdf[start:start + PDF_ENCODE_CHUNK])
+        yield self.tail
+
+
 def synthesize_with_gemini_comprehensive(pdf_uri, raw_text, existing_data):
     """Use Gemini with comprehensive prompt for full extraction"""
     project_id = os.getenv('GCP_PROJECT_ID')
@@ -43,16 +152,14 @@ def synthesize_with_gemini_comprehensive(pdf_uri, raw_text, existing_data):
     token = get_access_token()
     
     # Get PDF from GCS if URI provided
-    pdf_base64 = None
+    pdf_bytes = None
     if pdf_uri:
         try:
-            storage_client = storage.Client()
             bucket_name = pdf_uri.replace('gs://', '').split('/')[0]
             blob_path = '/'.join(pdf_uri.replace('gs://', '').split('/')[1:])
             bucket = storage_client.bucket(bucket_name)
             blob = bucket.blob(blob_path)
             pdf_bytes = blob.download_as_bytes()
-            pdf_base64 = base64.b64encode(pdf_bytes).decode('utf-8')
             print("PDF loaded successfully")
         except Exception as e:
             print(f"Failed to load PDF: {e}")
@@ -60,34 +167,19 @@ def synthesize_with_gemini_comprehensive(pdf_uri, raw_text, existing_data):
     # Load comprehensive extraction prompt
     extraction_prompt = load_extraction_prompt()
     
-    # Build full prompt
-    full_prompt = f"""{extraction_prompt}
-
-## DOCUMENT AI PRELIMINARY EXTRACTION (Reference)
+    # Only the Document AI reference changes per call; the schema prompt and the
+    # task instructions go in as their own text parts, reused as-is
+    reference = f"""## DOCUMENT AI PRELIMINARY EXTRACTION (Reference)
 
 Document AI provided the following preliminary extraction. Use this as a starting point, but re-extract and validate everything from the actual PDF document:
 ```json
-{json.dumps(existing_data, indent=2)}
+{orjson.dumps(existing_data, option=orjson.OPT_INDENT_2).decode()}
 ```
 
 ## RAW OCR TEXT (Additional Reference)
 ```
 {raw_text[:4000] if raw_text else 'Not available'}
-```
-
-## YOUR TASK
-1. Carefully review the PDF document provided
-2. Extract ALL invoice fields according to the comprehensive schema above
-3. Pay special attention to:
-   - **Line items**: Extract EVERY line item in the invoice table with all details
-   - **Amounts**: Remove currency symbols, ensure numeric values only
-   - **Dates**: Convert to MM/dd/yyyy format
-   - **Addresses**: Combine multi-line addresses into single formatted strings
-   - **Missing fields**: If Document AI missed fields, extract them now
-4. Return ONLY the JSON object with the exact field names from the schema
-5. Do NOT include markdown code blocks, explanations, or any extra text
-
-Output JSON:"""
+```"""
     
     headers = {
         'Authorization': f'Bearer {token}',
@@ -95,14 +187,18 @@ Output JSON:"""
     }
     
     # Build parts for the request
-    parts = [{"text": full_prompt}]
+    parts = [
+        {"text": extraction_prompt},
+        {"text": reference},
+        {"text": COMPREHENSIVE_TASK}
+    ]
     
-    # Add PDF if available
-    if pdf_base64:
+    # Add PDF if available; the placeholder is swapped for base64 while the body streams out
+    if pdf_bytes:
         parts.append({
             "inline_data": {
                 "mime_type": "application/pdf",
-                "data": pdf_base64
+                "data": PDF_PLACEHOLDER
             }
         })
     
@@ -118,14 +214,18 @@ Output JSON:"""
         }
     }
     
-    response = requests.post(url, headers=headers, json=payload, timeout=120)
+    body = orjson.dumps(payload)
+    if pdf_bytes:
+        body = PdfRequestBody(body, pdf_bytes)
+    
+    response = http.post(url, headers=headers, data=body, timeout=120)
     
     if response.status_code != 200:
         error_msg = f"Status {response.status_code}: {response.text}"
         print(f"Gemini API Error: {error_msg}")
         raise Exception(error_msg)
     
-    result = response.json()
+    result = orjson.loads(response.content)
     
     # Extract text from response
     try:
@@ -135,27 +235,58 @@ Output JSON:"""
         raise Exception(f"Failed to parse response: {e}")
     
     # Clean and parse JSON
-    text_response = text_response.strip()
-    if text_response.startswith('```json'):
-        text_response = text_response[7:]
-    if text_response.startswith('```'):
-        text_response = text_response[3:]
-    if text_response.endswith('```'):
-        text_response = text_response[:-3]
-    
-    text_response = text_response.strip()
+    text_response = strip_code_fence(text_response)
     
     try:
-        extracted_data = json.loads(text_response)
-    except json.JSONDecodeError as e:
+        extracted_data = orjson.loads(text_response)
+    except orjson.JSONDecodeError as e:
         print(f"Failed to parse JSON. First 500 chars: {text_response[:500]}")
         raise Exception(f"Invalid JSON from Gemini: {e}")
     
     return extracted_data
 
 
+FIELD_INSTRUCTIONS = """INSTRUCTIONS:
+1. For line items: Parse into array of objects with description, quantity, unit_price, amount, product_code
+2. For addresses: Combine multi-line into single formatted string
+3. For dates: Convert to YYYY-MM-DD format
+4. For amounts: Remove currency symbols, return numeric
+5. Return SAME field names as requested
+
+Return ONLY JSON:"""
+
+
 def synthesize_with_gemini_fields(raw_text, fields_to_improve, existing_data):
-    """Legacy function: Use Gemini to improve specific fields (fallback)"""
+    """Legacy function: Use Gemini to improve specific fields (fallback)
+    
+    Larger field sets are split into shards of FIELDS_PER_SHARD that are generated concurrently.
+    """
+    # Invoice text + current values are the same for every shard; format them once
+    context = f"""Invoice Text:
+{raw_text[:8000]}
+
+Current values:
+{orjson.dumps(existing_data, option=orjson.OPT_INDENT_2).decode()}"""
+    
+    if len(fields_to_improve) <= FIELDS_PER_SHARD:
+        return synthesize_field_shard(context, fields_to_improve)
+    
+    shards = [
+        fields_to_improve[i:i + FIELDS_PER_SHARD]
+        for i in range(0, len(fields_to_improve), FIELDS_PER_SHARD)
+    ]
+    print(f"Splitting {len(fields_to_improve)} fields into {len(shards)} parallel Gemini calls")
+    
+    improved_data = {}
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        for shard_result in executor.map(lambda shard: synthesize_field_shard(context, shard), shards):
+            improved_data.update(shard_result)
+    
+    return improved_data
+
+
+def synthesize_field_shard(context, fields_to_improve):
+    """One Gemini call improving the given fields"""
     project_id = os.getenv('GCP_PROJECT_ID')
     model_id = 'gemini-2.5-flash'
     
@@ -165,22 +296,7 @@ def synthesize_with_gemini_fields(raw_text, fields_to_improve, existing_data):
     
     field_names = [f['field'] for f in fields_to_improve]
     
-    prompt = f"""You are an expert invoice data extraction assistant. Extract and improve these fields: {', '.join(field_names)}
-
-Invoice Text:
-{raw_text[:8000]}
-
-Current values:
-{json.dumps(existing_data, indent=2)}
-
-INSTRUCTIONS:
-1. For line items: Parse into array of objects with description, quantity, unit_price, amount, product_code
-2. For addresses: Combine multi-line into single formatted string
-3. For dates: Convert to YYYY-MM-DD format
-4. For amounts: Remove currency symbols, return numeric
-5. Return SAME field names as requested
-
-Return ONLY JSON:"""
+    task = f"You are an expert invoice data extraction assistant. Extract and improve these fields: {', '.join(field_names)}"
     
     headers = {
         'Authorization': f'Bearer {token}',
@@ -190,7 +306,11 @@ Return ONLY JSON:"""
     payload = {
         "contents": {
             "role": "user",
-            "parts": {"text": prompt}
+            "parts": [
+                {"text": task},
+                {"text": context},
+                {"text": FIELD_INSTRUCTIONS}
+            ]
         },
         "generationConfig": {
             "temperature": 0.2,
@@ -198,25 +318,17 @@ Return ONLY JSON:"""
         }
     }
     
-    response = requests.post(url, headers=headers, json=payload, timeout=60)
+    response = http.post(url, headers=headers, data=orjson.dumps(payload), timeout=60)
     
     if response.status_code != 200:
         error_msg = f"Status {response.status_code}: {response.text}"
         print(f"Gemini API Error: {error_msg}")
         raise Exception(error_msg)
     
-    result = response.json()
-    text_response = result['candidates'][0]['content']['parts'][0]['text'].strip()
-    
-    # Clean JSON
-    if text_response.startswith('```json'):
-        text_response = text_response[7:]
-    if text_response.startswith('```'):
-        text_response = text_response[3:]
-    if text_response.endswith('```'):
-        text_response = text_response[:-3]
+    result = orjson.loads(response.content)
+    text_response = strip_code_fence(result['candidates'][0]['content']['parts'][0]['text'])
     
-    improved_data = json.loads(text_response.strip())
+    improved_data = orjson.loads(text_response)
     return improved_data
 
 
@@ -271,6 +383,5 @@ def synthesize_fields(request):
         
     except Exception as e:
         print(f"Error: {str(e)}")
-        import traceback
         traceback.print_exc()
         return {"status": "error", "error": str(e)}, 500
\ No newline at end of file
@@ -3,26 +3,39 @@ Validation Engine Cloud Function
 Applies business rules to validate invoices and detect exceptions
 """
 import functions_framework
-import os
-import json
-from datetime import datetime, timedelta
-from decimal import Decimal
+import orjson
+import traceback
+from datetime import datetime
 
+# Rule configuration, built once per instance rather than on every request
+REQUIRED_FIELDS = ("invoice_id", "invoice_number", "supplier_name", "total_amount", "invoice_date")
+LARGE_AMOUNT_THRESHOLD = 100000.00  # $100k threshold
+TAX_TOLERANCE = 0.01  # Allow small tolerance for rounding
+RECEIVED_STATUSES = frozenset(("COMPLETE", "RECEIVED"))
+MAX_BATCH_SIZE = 50  # invoices per request before the function risks timing out
 
-def validate_required_fields(invoice_data):
+
+def extract_totals(invoice_data):
+    """Coerce (total_amount, net_amount, total_tax_amount) to floats once for all rules"""
+    get = invoice_data.get
+    return (
+        float(get("total_amount") or 0),
+        float(get("net_amount") or 0),
+        float(get("total_tax_amount") or 0),
+    )
+
+
+def validate_required_fields(invoice_data, totals, today):
     """
     Check if required fields are present
     Exception Type: MISSING_REQUIRED_FIELDS
     """
     exceptions = []
-    required_fields = ["invoice_id", "invoice_number", "supplier_name", "total_amount", "invoice_date"]
-    missing_fields = []
-    
-    for field in required_fields:
-        value = invoice_data.get(field)
-        # FIX: Also check for None/null values
-        if value is None or not value or value == "UNKNOWN" or value == "":
-            missing_fields.append(field)
+    # None, "" and 0 are all falsy; "UNKNOWN" is the extractor's placeholder
+    missing_fields = [
+        field for field in REQUIRED_FIELDS
+        if not (value := invoice_data.get(field)) or value == "UNKNOWN"
+    ]
     
     if missing_fields:
         exceptions.append({
@@ -37,7 +50,22 @@ def validate_required_fields(invoice_data):
     return exceptions
 
 
-def validate_invoice_date(invoice_data):
+def parse_invoice_date(invoice_date_str):
+    """Parse MM/dd/yyyy or yyyy-mm-dd; None for any other shape"""
+    # Splitting and int() avoid strptime's regex machinery and still accept unpadded parts
+    if '/' in invoice_date_str:
+        month, day, year = invoice_date_str.split('/')
+        return datetime(int(year), int(month), int(day))
+    if '-' in invoice_date_str:
+        try:
+            return datetime.fromisoformat(invoice_date_str)
+        except ValueError:
+            year, month, day = invoice_date_str.split('-')
+            return datetime(int(year), int(month), int(day))
+    return None
+
+
+def validate_invoice_date(invoice_data, totals, today):
     """
     Check if invoice date is valid (not in future)
     Exception Type: FUTURE_DATE
@@ -50,15 +78,11 @@ def validate_invoice_date(invoice_data):
     
     try:
         # Parse date (handle MM/dd/yyyy format)
-        if '/' in invoice_date_str:
-            invoice_date = datetime.strptime(invoice_date_str, "%m/%d/%Y")
-        elif '-' in invoice_date_str:
-            invoice_date = datetime.strptime(invoice_date_str, "%Y-%m-%d")
-        else:
+        invoice_date = parse_invoice_date(invoice_date_str)
+        if invoice_date is None:
             return exceptions
         
-        today = datetime.now()
-        days_old = (today - invoice_date).days
+        days_old = today.toordinal() - invoice_date.toordinal()
         
 
         
@@ -79,15 +103,15 @@ def validate_invoice_date(invoice_data):
     return exceptions
 
 
-def validate_amount_threshold(invoice_data):
+def validate_amount_threshold(invoice_data, totals, today):
     """
     Check if invoice amount is unusually high
     Exception Type: LARGE_AMOUNT
     """
     exceptions = []
     
-    total_amount = float(invoice_data.get("total_amount", 0))
-    threshold = 100000.00  # $100k threshold
+    total_amount = totals[0]
+    threshold = LARGE_AMOUNT_THRESHOLD
     
     if total_amount > threshold:
         exceptions.append({
@@ -103,14 +127,14 @@ def validate_amount_threshold(invoice_data):
     return exceptions
 
 
-def validate_po_amount(invoice_data):
+def validate_po_amount(invoice_data, totals, today):
     """
     Check if invoice total amount exceeds PO amount
     Exception Type: EXCEEDS_PO_AMOUNT
     """
     exceptions = []
     
-    invoice_total = float(invoice_data.get("total_amount", 0))
+    invoice_total = totals[0]
     po_amount = invoice_data.get("po_amount")  # Expected from external system
     
     if po_amount is not None:
@@ -130,14 +154,14 @@ def validate_po_amount(invoice_data):
     return exceptions
 
 
-def validate_po_funds(invoice_data):
+def validate_po_funds(invoice_data, totals, today):
     """
     Check if PO has sufficient remaining funds
     Exception Type: INSUFFICIENT_PO_FUNDS
     """
     exceptions = []
     
-    invoice_total = float(invoice_data.get("total_amount", 0))
+    invoice_total = totals[0]
     po_remaining_balance = invoice_data.get("po_remaining_balance")  # Expected from external system
     
     if po_remaining_balance is not None:
@@ -157,7 +181,7 @@ def validate_po_funds(invoice_data):
     return exceptions
 
 
-def validate_po_receiving(invoice_data):
+def validate_po_receiving(invoice_data, totals, today):
     """
     Check if PO receiving has happened
     Exception Type: PO_RECEIVING_NOT_COMPLETE
@@ -168,7 +192,7 @@ def validate_po_receiving(invoice_data):
     po_number = invoice_data.get("purchase_order_number")
     
     if po_number and po_receiving_status is not None:
-        if po_receiving_status != "COMPLETE" and po_receiving_status != "RECEIVED":
+        if po_receiving_status not in RECEIVED_STATUSES:
             exceptions.append({
                 "type": "PO_RECEIVING_NOT_COMPLETE",
                 "severity": "high",
@@ -182,27 +206,23 @@ def validate_po_receiving(invoice_data):
     return exceptions
 
 
-def validate_tax_calculations(invoice_data):
+def validate_tax_calculations(invoice_data, totals, today):
     """
     Validate tax calculations are correct
     Exception Type: INCORRECT_TAX_CALCULATION
     """
     exceptions = []
     
-    net_amount = float(invoice_data.get("net_amount", 0))
-    tax_amount = float(invoice_data.get("total_tax_amount", 0))
-    total_amount = float(invoice_data.get("total_amount", 0))
+    total_amount, net_amount, tax_amount = totals
     
     # Only validate if we have the necessary amounts
     if net_amount > 0 and tax_amount >= 0:
         # Calculate expected total
         expected_total = net_amount + tax_amount
         
-        # Allow small tolerance for rounding (0.01)
-        tolerance = 0.01
         difference = abs(total_amount - expected_total)
         
-        if difference > tolerance:
+        if difference > TAX_TOLERANCE:
             exceptions.append({
                 "type": "INCORRECT_TAX_CALCULATION",
                 "severity": "high",
@@ -219,6 +239,71 @@ def validate_tax_calculations(invoice_data):
     return exceptions
 
 
+# Rules run in this order; each takes (invoice_data, totals, today) and returns its exceptions.
+# A gate rule that raises a high-severity exception skips every rule after it.
+RULES = (
+    ("required_fields_check", validate_required_fields, True),
+    ("invoice_date_check", validate_invoice_date, False),
+    ("amount_threshold_check", validate_amount_threshold, False),
+    ("po_amount_check", validate_po_amount, False),
+    ("po_funds_check", validate_po_funds, False),
+    ("po_receiving_check", validate_po_receiving, False),
+    ("tax_calculation_check", validate_tax_calculations, False),
+)
+
+
+def run_rules(invoice_data, today):
+    """Run RULES against one invoice and build its result"""
+    totals = extract_totals(invoice_data)
+    
+    # Run all validations
+    all_exceptions = []
+    validation_results = {}
+    
+    for name, rule, is_gate in RULES:
+        exceptions = rule(invoice_data, totals, today)
+        validation_results[name] = "passed" if not exceptions else "failed"
+        all_exceptions.extend(exceptions)
+        if is_gate and any(e["severity"] == "high" for e in exceptions):
+            break
+    
+    for name, _, _ in RULES:
+        validation_results.setdefault(name, "skipped")
+    
+    # Determine if this is an exception
+    is_exception = bool(all_exceptions)
+    requires_review = is_exception
+    
+    return {
+        "status": "success",
+        "is_exception": is_exception,
+        "requires_review": requires_review,
+        "exceptions": all_exceptions,
+        "exception_count": len(all_exceptions),
+        "validation_results": validation_results,
+        "invoice_id": invoice_data.get("invoice_id"),
+        "total_amount": invoice_data.get("total_amount")
+    }
+
+
+def json_response(body):
+    """Serialise a success body with orjson rather than Flask's stdlib encoder"""
+    return orjson.dumps(body), 200, {"Content-Type": "application/json"}
+
+
+def run_rules_safely(invoice_data, today):
+    """Validate one invoice of a batch; a failure becomes that entry's error result"""
+    try:
+        return run_rules(invoice_data, today)
+    except Exception as e:
+        print(f"Error validating invoice {invoice_data.get('invoice_id', 'unknown')}: {str(e)}")
+        return {
+            "status": "error",
+            "error": str(e),
+            "invoice_id": invoice_data.get("invoice_id")
+        }
+
+
 @functions_framework.http
 def validate_invoice(request):
     """
@@ -237,16 +322,44 @@ def validate_invoice(request):
         }
     }
     
+    or, to validate several invoices in one call (up to MAX_BATCH_SIZE):
+    {
+        "invoices": [{...}, {...}]
+    }
+    
     Returns:
     {
         "status": "success",
         "is_exception": false,
         "exceptions": []
     }
+    
+    or, for a batch, one such result per invoice in request order:
+    {
+        "status": "success",
+        "results": [...]
+    }
     """
     
     try:
-        request_json = request.get_json()
+        request_json = orjson.loads(request.get_data())
+        
+        # One clock read for the whole request, shared by every invoice in it
+        today = datetime.now()
+        
+        invoices = request_json.get("invoices")
+        if invoices is not None:
+            if not isinstance(invoices, list) or not all(isinstance(i, dict) for i in invoices):
+                return {'error': 'invoices must be a list of invoice objects'}, 400
+            if len(invoices) > MAX_BATCH_SIZE:
+                return {'error': f'At most {MAX_BATCH_SIZE} invoices per request'}, 400
+            
+            print(f"Validating batch of {len(invoices)} invoices")
+            return json_response({
+                "status": "success",
+                "results": [run_rules_safely(invoice_data, today) for invoice_data in invoices]
+            })
+        
         invoice_data = request_json.get("invoice_data")
         
         if not invoice_data:
@@ -254,62 +367,12 @@ def validate_invoice(request):
         
         print(f"Validating invoice: {invoice_data.get('invoice_id', 'unknown')}")
         
-        # Run all validations
-        all_exceptions = []
-        validation_results = {}
-        
-        # NEW: Check required fields
-        exceptions = validate_required_fields(invoice_data)
-        validation_results["required_fields_check"] = "passed" if len(exceptions) == 0 else "failed"
-        all_exceptions.extend(exceptions)
-        
-        # NEW: Check invoice date
-        exceptions = validate_invoice_date(invoice_data)
-        validation_results["invoice_date_check"] = "passed" if len(exceptions) == 0 else "failed"
-        all_exceptions.extend(exceptions)
-        
-        # NEW: Check amount threshold
-        exceptions = validate_amount_threshold(invoice_data)
-        validation_results["amount_threshold_check"] = "passed" if len(exceptions) == 0 else "failed"
-        all_exceptions.extend(exceptions)
-        
-        # Existing validations
-        exceptions = validate_po_amount(invoice_data)
-        validation_results["po_amount_check"] = "passed" if len(exceptions) == 0 else "failed"
-        all_exceptions.extend(exceptions)
-        
-        exceptions = validate_po_funds(invoice_data)
-        validation_results["po_funds_check"] = "passed" if len(exceptions) == 0 else "failed"
-        all_exceptions.extend(exceptions)
-        
-        exceptions = validate_po_receiving(invoice_data)
-        validation_results["po_receiving_check"] = "passed" if len(exceptions) == 0 else "failed"
-        all_exceptions.extend(exceptions)
-        
-        exceptions = validate_tax_calculations(invoice_data)
-        validation_results["tax_calculation_check"] = "passed" if len(exceptions) == 0 else "failed"
-        all_exceptions.extend(exceptions)
-        
-        # Determine if this is an exception
-        is_exception = len(all_exceptions) > 0
-        requires_review = is_exception
-        
-        return {
-            "status": "success",
-            "is_exception": is_exception,
-            "requires_review": requires_review,
-            "exceptions": all_exceptions,
-            "exception_count": len(all_exceptions),
-            "validation_results": validation_results,
-            "invoice_id": invoice_data.get("invoice_id"),
-            "total_amount": invoice_data.get("total_amount")
-        }
+        return json_response(run_rules(invoice_data, today))
         
     except Exception as e:
         print(f"Error in validation: {str(e)}")
-        import traceback
         traceback.print_exc()
         return {
             "status": "error",
             "error": str(e)
-        }, 500
\ No newline at end of file
+        }, 500
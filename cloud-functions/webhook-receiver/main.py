@@ -4,13 +4,26 @@ Receives notifications from Microsoft Graph API when new emails arrive
 """
 import functions_framework
 import os
-import json
+import orjson
 import hmac
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import workflows_v1
 from google.cloud.workflows import executions_v1
 from google.cloud.workflows.executions_v1 import Execution
 
+# Graph batches several notifications per POST; start their workflows side by side
+MAX_PARALLEL_TRIGGERS = 10
+
+# Fully qualified workflow path
+WORKFLOW_PATH = f"projects/{os.getenv('GCP_PROJECT_ID')}/locations/{os.getenv('GCP_REGION')}/workflows/invoice-processing-workflow"
+
+# Webhook secret as bytes, encoded once
+WEBHOOK_SECRET = os.getenv('OUTLOOK_WEBHOOK_SECRET', '').encode('utf-8')
+
+# One execution client (and gRPC channel) per instance, shared by every request and trigger thread
+execution_client = executions_v1.ExecutionsClient()
+
 
 def verify_webhook_signature(request):
     """
@@ -19,15 +32,12 @@ def verify_webhook_signature(request):
     # Get the signature from headers
     signature = request.headers.get('X-Microsoft-Signature')
     
-    if not signature:
+    if not signature or not WEBHOOK_SECRET:
         return False
     
-    # Get the webhook secret
-    secret = os.getenv('OUTLOOK_WEBHOOK_SECRET').encode('utf-8')
-    
-    # Calculate expected signature
+    # Calculate expected signature (one-shot C digest, no HMAC object)
     body = request.get_data()
-    expected_signature = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    expected_signature = hmac.digest(WEBHOOK_SECRET, body, hashlib.sha256).hex()
     
     # Compare signatures
     return hmac.compare_digest(signature, expected_signature)
@@ -37,21 +47,11 @@ def trigger_workflow(email_data):
     """
     Trigger Cloud Workflow to process the email
     """
-    project_id = os.getenv('GCP_PROJECT_ID')
-    location = os.getenv('GCP_REGION')
-    workflow_id = 'invoice-processing-workflow'
-    
-    # Create workflow execution client
-    execution_client = executions_v1.ExecutionsClient()
-    
-    # Construct the fully qualified workflow path
-    workflow_path = f"projects/{project_id}/locations/{location}/workflows/{workflow_id}"
-    
     # Create execution request
-    execution = Execution(argument=json.dumps(email_data))
+    execution = Execution(argument=orjson.dumps(email_data).decode())
     
     request = executions_v1.CreateExecutionRequest(
-        parent=workflow_path,
+        parent=WORKFLOW_PATH,
         execution=execution
     )
     
@@ -87,9 +87,11 @@ def webhook_receiver(request):
             #     return {'error': 'Invalid signature'}, 401
             
             # Parse the notification
-            notification_data = request.get_json()
+            body = request.get_data()
+            notification_data = orjson.loads(body)
             
-            print(f"Received notification: {json.dumps(notification_data)}")
+            # Log the body as received rather than re-serialising the parsed dict
+            print(f"Received notification: {body.decode('utf-8', 'replace')}")
             
             # Microsoft Graph sends notifications in this format:
             # {
@@ -103,6 +105,7 @@ def webhook_receiver(request):
             #   ]
             # }
             
+            emails = []
             if 'value' in notification_data:
                 for notification in notification_data['value']:
                     # Extract email details
@@ -116,15 +119,17 @@ def webhook_receiver(request):
                         message_id = resource.split('/')[-1]
                         
                         # Prepare data for workflow
-                        email_data = {
+                        emails.append({
                             'message_id': message_id,
                             'resource': resource,
                             'change_type': change_type,
                             'subscription_id': notification.get('subscriptionId')
-                        }
-                        
-                        # Trigger workflow
-                        execution_name = trigger_workflow(email_data)
+                        })
+            
+            # Trigger workflows
+            if emails:
+                with ThreadPoolExecutor(max_workers=min(len(emails), MAX_PARALLEL_TRIGGERS)) as executor:
+                    for execution_name in executor.map(trigger_workflow, emails):
                         print(f"Triggered workflow: {execution_name}")
             
             # Always return 202 Accepted to Microsoft
@@ -210,18 +210,15 @@ function App() {
 
   const handleDownloadPdf = async (exceptionId, filename) => {
     try {
-      const response = await axios.get(`${API_URL}/api/exceptions/${exceptionId}/pdf`, {
-        responseType: 'blob'
-      });
-      const url = window.URL.createObjectURL(new Blob([response.data], { type: 'application/pdf' }));
+      // Navigate rather than fetch: the API redirects to a signed GCS URL, which an
+      // XHR would follow cross-origin; ?download=true makes GCS send it as an attachment
       const link = document.createElement('a');
-      link.href = url;
+      link.href = `${API_URL}/api/exceptions/${exceptionId}/pdf?download=true`;
       link.setAttribute('download', filename || 'invoice.pdf');
       document.body.appendChild(link);
       link.click();
       link.remove();
-      window.URL.revokeObjectURL(url);
-      showSnackbar('PDF downloaded successfully', 'success');
+      showSnackbar('PDF download started', 'success');
     } catch (err) {
       console.error(err);
       showSnackbar('Failed to download PDF', 'error');
@@ -35,7 +35,7 @@ function InvoiceTesting() {
   const fetchInvoices = async () => {
     try {
       // Query BigQuery for all processed invoices
-      const response = await axios.get(`${API_URL}/api/invoices/all`);
+      const response = await axios.get(`${API_URL}/api/invoices/all`, { params: { include_raw: true } });
       setInvoices(response.data);
     } catch (err) {
       console.error('Failed to fetch invoices:', err);
@@ -52,7 +52,7 @@ function App() {
   const fetchInvoices = async () => {
     setLoading(true);
     try {
-      const response = await axios.get(`${API_URL}/api/invoices/all`);
+      const response = await axios.get(`${API_URL}/api/invoices/all`, { params: { include_raw: true } });
       setInvoices(response.data);
     } catch (err) {
       console.error('Failed to fetch invoices:', err);
@@ -0,0 +1,21 @@
+#!/bin/bash
+
+# Set BigQuery clustering on exception_reviews
+#
+# exception_reviews is clustered by (exception_id, reviewed_at) so the
+# latest-review lookups in the backend read only the blocks for the
+# exceptions they need. exceptions gets its partitioning and clustering from
+# partition-exceptions-table.sh.
+#
+# Clustering applies to newly written data; BigQuery reclusters existing
+# rows in the background.
+
+PROJECT_ID="consulevent-ap-invoice"
+DATASET_ID="invoice_processing"
+
+echo "Clustering exception_reviews by exception_id, reviewed_at..."
+bq update \
+  --clustering_fields=exception_id,reviewed_at \
+  "$PROJECT_ID:$DATASET_ID.exception_reviews"
+
+echo "Clustering update complete!"
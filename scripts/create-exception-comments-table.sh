@@ -0,0 +1,51 @@
+#!/bin/bash
+
+# Create the exception_comments table and backfill it from exceptions.comments
+#
+# Exception comments live in their own append-only table (one row per
+# comment) instead of a JSON array rewritten on the exceptions row for every
+# add/delete. Clustered by exception_id so the per-exception comment reads
+# touch only that exception's blocks.
+#
+# Safe to run more than once: the table is created only if missing and the
+# backfill skips comment_ids that are already present.
+
+PROJECT_ID="consulevent-ap-invoice"
+DATASET_ID="invoice_processing"
+
+echo "Creating exception_comments table..."
+bq query --use_legacy_sql=false "
+CREATE TABLE IF NOT EXISTS \`$PROJECT_ID.$DATASET_ID.exception_comments\` (
+  comment_id STRING NOT NULL,
+  exception_id STRING NOT NULL,
+  created_at TIMESTAMP NOT NULL,
+  created_by STRING,
+  comment_text STRING,
+  status STRING NOT NULL
+)
+CLUSTER BY exception_id
+"
+
+echo "Backfilling existing comments from exceptions.comments..."
+bq query --use_legacy_sql=false "
+INSERT INTO \`$PROJECT_ID.$DATASET_ID.exception_comments\`
+  (comment_id, exception_id, created_at, created_by, comment_text, status)
+SELECT
+  JSON_VALUE(c, '$.comment_id'),
+  e.exception_id,
+  TIMESTAMP(JSON_VALUE(c, '$.created_at')),
+  JSON_VALUE(c, '$.created_by'),
+  JSON_VALUE(c, '$.comment_text'),
+  JSON_VALUE(c, '$.status')
+FROM \`$PROJECT_ID.$DATASET_ID.exceptions\` e,
+  UNNEST(JSON_QUERY_ARRAY(e.comments)) c
+WHERE e.comments IS NOT NULL
+  -- Safe to rerun: comments already migrated are skipped
+  AND NOT EXISTS (
+    SELECT 1
+    FROM \`$PROJECT_ID.$DATASET_ID.exception_comments\` x
+    WHERE x.comment_id = JSON_VALUE(c, '$.comment_id')
+  )
+"
+
+echo "exception_comments ready!"
@@ -0,0 +1,30 @@
+#!/bin/bash
+
+# Create the exception_reviews_latest materialized view
+#
+# One row per exception holding its most recent review. The backend joins
+# this instead of re-aggregating the whole exception_reviews table on every
+# list/detail/stats request. MAX_BY keeps the view incrementally
+# refreshable, and BigQuery merges in reviews written since the last
+# refresh at query time, so a new review is visible immediately.
+
+PROJECT_ID="consulevent-ap-invoice"
+DATASET_ID="invoice_processing"
+
+echo "Creating exception_reviews_latest materialized view..."
+bq query --use_legacy_sql=false "
+CREATE MATERIALIZED VIEW IF NOT EXISTS \`$PROJECT_ID.$DATASET_ID.exception_reviews_latest\`
+CLUSTER BY exception_id
+OPTIONS (enable_refresh = true, refresh_interval_minutes = 5)
+AS
+SELECT
+  exception_id,
+  MAX_BY(status, reviewed_at) AS review_status,
+  MAX_BY(reviewed_by, reviewed_at) AS reviewed_by,
+  MAX(reviewed_at) AS reviewed_at,
+  MAX_BY(review_comments, reviewed_at) AS review_comments
+FROM \`$PROJECT_ID.$DATASET_ID.exception_reviews\`
+GROUP BY exception_id
+"
+
+echo "Materialized view created!"
@@ -0,0 +1,64 @@
+#!/bin/bash
+
+# Rebuild the exceptions table partitioned by received_date
+#
+# list_exceptions and get_statistics always filter on received_date, so with
+# daily partitions a 30-day window scans ~30 partitions instead of the whole
+# table. Clustering by severity/status/exception_id keeps the dashboard
+# filters and the per-exception lookups cheap within a partition.
+#
+# Partitioning can't be added to an existing table, so the data is copied
+# into a partitioned table which then replaces the original. Pause the
+# invoice-processing workflow (it streams rows in via tabledata.insertAll)
+# and the backend's /api/test/write-to-bq and scripts/write-to-bq.py writers
+# while this runs, and wait for the streaming buffer to drain: BigQuery
+# refuses to rename a table that still has buffered rows.
+#
+# The original table is never dropped here. It is renamed to
+# exceptions_backup_<timestamp> only after the partitioned copy's row count
+# matches; drop the backup by hand once the dashboard checks out.
+#
+# require_partition_filter is deliberately left off: the detail, comment and
+# PDF endpoints look exceptions up by exception_id alone.
+
+set -euo pipefail
+
+PROJECT_ID="consulevent-ap-invoice"
+DATASET_ID="invoice_processing"
+BACKUP_TABLE="exceptions_backup_$(date +%Y%m%d%H%M%S)"
+
+row_count() {
+  bq query --use_legacy_sql=false --format=csv --quiet \
+    "SELECT COUNT(*) FROM \`$PROJECT_ID.$DATASET_ID.$1\`" | tail -n 1
+}
+
+echo "Copying exceptions into a partitioned table..."
+bq query --use_legacy_sql=false "
+CREATE OR REPLACE TABLE \`$PROJECT_ID.$DATASET_ID.exceptions_partitioned\`
+PARTITION BY received_date
+CLUSTER BY exception_severity, status, exception_id
+AS SELECT * FROM \`$PROJECT_ID.$DATASET_ID.exceptions\`
+"
+
+echo "Checking row counts..."
+ORIGINAL_ROWS=$(row_count exceptions)
+PARTITIONED_ROWS=$(row_count exceptions_partitioned)
+if [ "$ORIGINAL_ROWS" != "$PARTITIONED_ROWS" ]; then
+  echo "Row count mismatch: exceptions=$ORIGINAL_ROWS exceptions_partitioned=$PARTITIONED_ROWS" >&2
+  echo "Nothing was replaced; inspect exceptions_partitioned and rerun." >&2
+  exit 1
+fi
+echo "   $ORIGINAL_ROWS rows in both tables"
+
+echo "Moving exceptions aside as $BACKUP_TABLE..."
+bq query --use_legacy_sql=false "
+ALTER TABLE \`$PROJECT_ID.$DATASET_ID.exceptions\` RENAME TO \`$BACKUP_TABLE\`
+"
+
+echo "Promoting the partitioned copy to exceptions..."
+bq query --use_legacy_sql=false "
+ALTER TABLE \`$PROJECT_ID.$DATASET_ID.exceptions_partitioned\` RENAME TO \`exceptions\`
+"
+
+echo "Partitioning complete!"
+echo "Once verified, drop the backup: bq rm -f -t $PROJECT_ID:$DATASET_ID.$BACKUP_TABLE"
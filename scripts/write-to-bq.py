@@ -1,12 +1,30 @@
 #!/usr/bin/env python3
 """
 Helper script to write invoice data to BigQuery
-Uses parameterized queries like the backend to properly handle JSON
+Streams rows over the Storage Write API like the backend, JSON columns as JSON text
 """
+import os
+import queue
 import sys
-import json
-from datetime import datetime
+import threading
+import time
+import orjson
+from collections import deque
+from datetime import date, datetime, timezone
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
+from google.cloud.bigquery_storage_v1 import types as bqs_types
+from google.cloud.bigquery_storage_v1 import writer as bqs_writer
+
+# Row layouts are shared with the backend's Storage Write path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from bq_rows import DATE, DOUBLE, EPOCH_DATE, STRING, TIMESTAMP, WRITE_TABLE_FIELDS, row_type
+
+PROJECT_ID = "consulevent-ap-invoice"
+DATASET_ID = "invoice_processing"
+
+# One client (one gRPC channel) for every batch this process writes
+write_client = bigquery_storage.BigQueryWriteClient()
 
 def parse_date(date_str):
     """Parse date string to date object, return None if invalid format"""
@@ -15,77 +33,189 @@ def parse_date(date_str):
     try:
         # Try YYYY-MM-DD format first
         if len(date_str) == 10 and date_str[4] == '-' and date_str[7] == '-':
-            return datetime.strptime(date_str, "%Y-%m-%d").date()
+            return date(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]))
         # Try M/D/YYYY format (e.g., "6/4/2025")
         if '/' in date_str:
             parts = date_str.split('/')
-            if len(parts) == 3:
+            if len(parts) == 3 and len(parts[2]) == 4:
                 month, day, year = parts
-                return datetime.strptime(f"{year}-{month.zfill(2)}-{day.zfill(2)}", "%Y-%m-%d").date()
+                return date(int(year), int(month), int(day))
         return None
     except (ValueError, IndexError):
         return None
 
-def write_to_bigquery(table_name, data):
-    project_id = "consulevent-ap-invoice"
-    dataset_id = "invoice_processing"
-    
-    client = bigquery.Client(project=project_id)
+# Rows per AppendRowsRequest (or per INSERT job with the DML fallback) when reading a stream of rows
+BATCH_SIZE = 100
+
+# A partial batch is sent once its first row has waited this long, so a slow producer isn't held back
+FLUSH_INTERVAL = 0.25
+
+# Appends in flight before the oldest acknowledgement is awaited
+MAX_PENDING_APPENDS = 10
+
+# WRITE_TO_BQ_METHOD=dml falls back to INSERT jobs for callers without Storage Write access
+WRITE_METHOD = os.getenv("WRITE_TO_BQ_METHOD", "storage")
+
+# DML fallback: how each column's Storage Write encoding is bound and converted back in SQL
+JSON_COLUMNS = {"all_exceptions", "raw_extracted_data"}
+DML_PARAM_TYPES = {STRING: "STRING", DOUBLE: "FLOAT64", DATE: "INT64", TIMESTAMP: "INT64"}
+DML_CONVERSIONS = {DATE: "DATE_FROM_UNIX_DATE({})", TIMESTAMP: "TIMESTAMP_MICROS({})"}
+
+def epoch_days(value):
+    """DATE columns go over the Storage Write API as days since epoch"""
+    return (value - EPOCH_DATE).days if value else None
+
+def build_row(table_name, data):
+    """Map the CLI's JSON payload onto the table's columns"""
+    today = datetime.now(timezone.utc).date()
+    row = {
+        "invoice_id": data["invoice_id"],
+        "message_id": data["message_id"],
+        "filename": data["filename"],
+        "gcs_uri": data["gcs_uri"],
+        "received_date": epoch_days(today),
+        "invoice_date": epoch_days(parse_date(data.get("invoice_date"))),
+        "supplier_name": data.get("supplier_name"),
+        "total_amount": float(data["total_amount"]) if data.get("total_amount") else None,
+        "raw_extracted_data": orjson.dumps(data["raw_extracted_data"]).decode() if data.get("raw_extracted_data") else "{}"
+    }
     
     if table_name == "invoices_processed":
-        query = f"""
-        INSERT INTO `{project_id}.{dataset_id}.invoices_processed`
-        (invoice_id, message_id, filename, gcs_uri, received_date, invoice_date, supplier_name, total_amount, net_amount, total_tax_amount, currency, raw_extracted_data)
-        VALUES (@invoice_id, @message_id, @filename, @gcs_uri, CURRENT_DATE(), @invoice_date, @supplier_name, @total_amount, @net_amount, @total_tax_amount, @currency, PARSE_JSON(@raw_extracted_data))
-        """
-        
-        raw_data_json = json.dumps(data["raw_extracted_data"]) if data.get("raw_extracted_data") else "{}"
-        
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("invoice_id", "STRING", data["invoice_id"]),
-                bigquery.ScalarQueryParameter("message_id", "STRING", data["message_id"]),
-                bigquery.ScalarQueryParameter("filename", "STRING", data["filename"]),
-                bigquery.ScalarQueryParameter("gcs_uri", "STRING", data["gcs_uri"]),
-                bigquery.ScalarQueryParameter("invoice_date", "DATE", parse_date(data.get("invoice_date"))),
-                bigquery.ScalarQueryParameter("supplier_name", "STRING", data.get("supplier_name")),
-                bigquery.ScalarQueryParameter("total_amount", "FLOAT64", float(data["total_amount"]) if data.get("total_amount") else None),
-                bigquery.ScalarQueryParameter("net_amount", "FLOAT64", float(data["net_amount"]) if data.get("net_amount") else None),
-                bigquery.ScalarQueryParameter("total_tax_amount", "FLOAT64", float(data["total_tax_amount"]) if data.get("total_tax_amount") else None),
-                bigquery.ScalarQueryParameter("currency", "STRING", data.get("currency")),
-                bigquery.ScalarQueryParameter("raw_extracted_data", "STRING", raw_data_json)
-            ]
-        )
+        row.update({
+            "net_amount": float(data["net_amount"]) if data.get("net_amount") else None,
+            "total_tax_amount": float(data["total_tax_amount"]) if data.get("total_tax_amount") else None,
+            "currency": data.get("currency")
+        })
     else:  # exceptions
-        query = f"""
-        INSERT INTO `{project_id}.{dataset_id}.exceptions`
-        (exception_id, invoice_id, message_id, filename, gcs_uri, received_date, invoice_date, supplier_name, total_amount, exception_type, exception_severity, all_exceptions, status, raw_extracted_data)
-        VALUES (@exception_id, @invoice_id, @message_id, @filename, @gcs_uri, CURRENT_DATE(), @invoice_date, @supplier_name, @total_amount, @exception_type, @exception_severity, PARSE_JSON(@all_exceptions), 'PENDING', PARSE_JSON(@raw_extracted_data))
-        """
-        
-        all_exceptions_json = json.dumps(data["all_exceptions"]) if data.get("all_exceptions") else "[]"
-        raw_data_json = json.dumps(data["raw_extracted_data"]) if data.get("raw_extracted_data") else "{}"
-        
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("exception_id", "STRING", data["exception_id"]),
-                bigquery.ScalarQueryParameter("invoice_id", "STRING", data["invoice_id"]),
-                bigquery.ScalarQueryParameter("message_id", "STRING", data["message_id"]),
-                bigquery.ScalarQueryParameter("filename", "STRING", data["filename"]),
-                bigquery.ScalarQueryParameter("gcs_uri", "STRING", data["gcs_uri"]),
-                bigquery.ScalarQueryParameter("invoice_date", "DATE", parse_date(data.get("invoice_date"))),
-                bigquery.ScalarQueryParameter("supplier_name", "STRING", data.get("supplier_name")),
-                bigquery.ScalarQueryParameter("total_amount", "FLOAT64", float(data["total_amount"]) if data.get("total_amount") else None),
-                bigquery.ScalarQueryParameter("exception_type", "STRING", data["exception_type"]),
-                bigquery.ScalarQueryParameter("exception_severity", "STRING", data["exception_severity"]),
-                bigquery.ScalarQueryParameter("all_exceptions", "STRING", all_exceptions_json),
-                bigquery.ScalarQueryParameter("raw_extracted_data", "STRING", raw_data_json)
-            ]
+        row.update({
+            "exception_id": data["exception_id"],
+            "exception_type": data["exception_type"],
+            "exception_severity": data["exception_severity"],
+            "all_exceptions": orjson.dumps(data["all_exceptions"]).decode() if data.get("all_exceptions") else "[]",
+            "status": "PENDING",
+            "created_at": int(datetime.now(timezone.utc).timestamp() * 1_000_000)
+        })
+    
+    return row
+
+_END = object()
+
+def batches(rows, size, interval=FLUSH_INTERVAL):
+    """Group rows into lists of at most size, flushing a partial batch once it is interval seconds old"""
+    # rows may block (stdin), so they are read on a thread and the timeout applies to the queue
+    pending = queue.Queue(maxsize=size)
+    
+    def feed():
+        try:
+            for row in rows:
+                pending.put((row, None))
+            pending.put((_END, None))
+        except Exception as e:
+            pending.put((_END, e))
+    
+    threading.Thread(target=feed, daemon=True).start()
+    
+    batch = []
+    deadline = None
+    while True:
+        try:
+            row, error = pending.get(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            yield batch
+            batch, deadline = [], None
+            continue
+        if row is _END:
+            if error:
+                raise error
+            break
+        batch.append(row)
+        if deadline is None:
+            deadline = time.monotonic() + interval
+        if len(batch) == size:
+            yield batch
+            batch, deadline = [], None
+    if batch:
+        yield batch
+
+def read_ndjson(stream):
+    """One JSON object per non-blank line"""
+    for line in stream:
+        if line.strip():
+            yield orjson.loads(line)
+
+def write_to_bigquery(table_name, rows):
+    # Append to the table's default write stream: no DML job, no DML quota
+    row_class, message_proto = row_type(table_name)
+    
+    try:
+        request_template = bqs_types.AppendRowsRequest(
+            write_stream=f"{write_client.table_path(PROJECT_ID, DATASET_ID, table_name)}/streams/_default",
+            proto_rows=bqs_types.AppendRowsRequest.ProtoData(
+                writer_schema=bqs_types.ProtoSchema(proto_descriptor=message_proto)
+            )
         )
+        stream = bqs_writer.AppendRowsStream(write_client, request_template)
+        try:
+            # One AppendRowsRequest per batch; requests are pipelined, at most MAX_PENDING_APPENDS unacknowledged
+            futures = deque()
+            for batch in batches(rows, BATCH_SIZE):
+                # The whole batch is built first so a bad row fails it before any of it is sent
+                serialized_rows = []
+                for data in batch:
+                    row = build_row(table_name, data)
+                    message = row_class(**{name: value for name, value in row.items() if value is not None})
+                    serialized_rows.append(message.SerializeToString())
+                futures.append(stream.send(bqs_types.AppendRowsRequest(
+                    proto_rows=bqs_types.AppendRowsRequest.ProtoData(
+                        rows=bqs_types.ProtoRows(serialized_rows=serialized_rows)
+                    )
+                )))
+                if len(futures) >= MAX_PENDING_APPENDS:
+                    futures.popleft().result()  # Surface a rejected append without waiting for the end
+            while futures:
+                futures.popleft().result()  # Wait for each append to be acknowledged
+        finally:
+            stream.close()
+        
+        print("SUCCESS")
+        return 0
+    except Exception as e:
+        print(f"ERROR: {str(e)}", file=sys.stderr)
+        return 1
+
+def dml_expression(name, field_type, param):
+    """SQL for one bound value in a multi-row INSERT"""
+    if name in JSON_COLUMNS:
+        return f"PARSE_JSON(@{param})"
+    return DML_CONVERSIONS.get(field_type, "{}").format(f"@{param}")
+
+def write_to_bigquery_dml(table_name, rows):
+    """One multi-row INSERT job per BATCH_SIZE rows, parameters suffixed by row index"""
+    client = bigquery.Client(project=PROJECT_ID)
+    fields = WRITE_TABLE_FIELDS[table_name]
+    columns = ", ".join(name for name, _ in fields)
     
     try:
-        query_job = client.query(query, job_config=job_config)
-        query_job.result()  # Wait for completion
+        for batch in batches(rows, BATCH_SIZE):
+            values = []
+            query_parameters = []
+            for index, data in enumerate(batch):
+                row = build_row(table_name, data)
+                expressions = []
+                for name, field_type in fields:
+                    param = f"{name}_{index}"
+                    expressions.append(dml_expression(name, field_type, param))
+                    query_parameters.append(bigquery.ScalarQueryParameter(param, DML_PARAM_TYPES[field_type], row.get(name)))
+                values.append(f"({', '.join(expressions)})")
+            
+            query = f"""
+            INSERT INTO `{PROJECT_ID}.{DATASET_ID}.{table_name}`
+            ({columns})
+            VALUES {', '.join(values)}
+            """
+            job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+            client.query(query, job_config=job_config).result()  # Wait for completion
+        
         print("SUCCESS")
         return 0
     except Exception as e:
@@ -93,11 +223,18 @@ def write_to_bigquery(table_name, data):
         return 1
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: write-to-bq.py <table_name> <json_data>", file=sys.stderr)
+    if len(sys.argv) < 2:
+        print("Usage: write-to-bq.py <table_name> [<json_data> | - < rows.ndjson]", file=sys.stderr)
         sys.exit(1)
     
     table_name = sys.argv[1]
-    json_data = json.loads(sys.argv[2])
     
-    sys.exit(write_to_bigquery(table_name, json_data))
+    # No payload (or "-") reads newline-delimited JSON rows from stdin
+    if len(sys.argv) < 3 or sys.argv[2] == "-":
+        rows = read_ndjson(sys.stdin.buffer)
+    else:
+        rows = [orjson.loads(sys.argv[2])]
+    
+    if WRITE_METHOD == "dml":
+        sys.exit(write_to_bigquery_dml(table_name, rows))
+    sys.exit(write_to_bigquery(table_name, rows))
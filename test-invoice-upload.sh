@@ -392,7 +392,8 @@ else
     
     # Use Python script with parameterized queries (like backend) to handle JSON properly
     echo "   Executing BigQuery INSERT using Python script..."
-    PYTHON_OUTPUT=$($PYTHON_CMD scripts/write-to-bq.py "invoices_processed" "$PYTHON_DATA" 2>&1)
+    # Row goes in as one NDJSON line on stdin, so large extracted data never hits argv limits
+    PYTHON_OUTPUT=$(echo "$PYTHON_DATA" | jq -c . | $PYTHON_CMD scripts/write-to-bq.py "invoices_processed" - 2>&1)
     PYTHON_EXIT_CODE=$?
     
     if [ $PYTHON_EXIT_CODE -eq 0 ] && echo "$PYTHON_OUTPUT" | grep -q "SUCCESS"; then
@@ -402,7 +403,7 @@ else
         echo "❌ Failed to write to BigQuery invoices_processed table"
         echo "Error output: $PYTHON_OUTPUT"
         echo ""
-        echo "💡 Check Python dependencies: pip install google-cloud-bigquery"
+        echo "💡 Check Python dependencies: pip install google-cloud-bigquery google-cloud-bigquery-storage orjson"
         echo "   Check BigQuery permissions and table schema"
         exit 1
     fi